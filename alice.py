@@ -1,37 +1,47 @@
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class AliceRequest(object):
-    def __init__(self, request_dict):
-        self._request_dict = request_dict
-
-    @property
-    def version(self):
-        return self._request_dict['version']
-
-    @property
-    def session(self):
-        return self._request_dict['session']
 
-    @property
-    def user_id(self):
-        return self.session['user_id']
+def loads(data):
+    """
+    Разбирает JSON запроса. Если установлен orjson, используется он.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode()
+    return json.loads(data)
 
-    @property
-    def is_new_session(self):
-        return bool(self.session['new'])
 
-    @property
-    def command(self):
-        print(self._request_dict['request']['command'])
-        return self._request_dict['request']['command']
+class AliceRequest(object):
+    """
+    Запрос Алисы. Нужные поля разбираются один раз при создании.
+    """
+    __slots__ = ('_request_dict', 'version', 'session', 'user_id', 'is_new_session',
+                 'command', 'tokens', '_entities')
 
-    @property
-    def tokens(self):
-        return self._request_dict['request']['nlu']['tokens']
+    def __init__(self, request_dict):
+        self._request_dict = request_dict
+        self.version = request_dict['version']
+        self.session = request_dict['session']
+        self.user_id = self.session['user_id']
+        self.is_new_session = bool(self.session['new'])
+        request = request_dict['request']
+        self.command = request['command']
+        nlu = request['nlu']
+        self.tokens = nlu['tokens']
+        self._entities = nlu.get('entities') or []
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(loads(data))
 
     def get_number(self):
-        for e in self._request_dict['request']['nlu'].get('entities'):
+        for e in self._entities:
             if e.get('type') == "YANDEX.NUMBER":
                 return e.get('value')
         return None
@@ -41,6 +51,13 @@ class AliceRequest(object):
 
 
 class AliceResponse(object):
+    """
+    Ответ Алисе. По умолчанию сериализуется в компактный JSON,
+    pretty = True включает читаемый формат для отладки.
+    """
+    __slots__ = ('_response_dict',)
+    pretty = False
+
     def __init__(self, alice_request):
         self._response_dict = {
             "version": alice_request.version,
@@ -51,10 +68,18 @@ class AliceResponse(object):
         }
 
     def dumps(self):
+        if self.pretty:
+            return json.dumps(
+                self._response_dict,
+                ensure_ascii=False,
+                indent=2
+            )
+        if orjson is not None:
+            return orjson.dumps(self._response_dict).decode()
         return json.dumps(
             self._response_dict,
             ensure_ascii=False,
-            indent=2
+            separators=(',', ':')
         )
 
     def set_text(self, text):
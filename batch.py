@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Пакетный прогон запросов Алисы через навык без HTTP сервера:
+AliceRequest -> DialogHandler -> AliceResponse. Запросы одной сессии
+обрабатываются по порядку в одном процессе, независимые сессии
+распределяются по пулу процессов. Входной файл читается потоком, запросы
+разных сессий в нём могут идти вперемешку. Ответы и время каждого хода
+пишутся в JSONL по мере готовности.
+
+Usage:
+  batch.py <input> <output> [--mongo=<uri>] [--db=<name>] [--recipes=<file>]
+           [--search=<backend>] [--processes=<n>] [--log-level=<level>]
+  batch.py -h | --help
+
+Options:
+  -h --help            Показать эту справку.
+  --mongo=<uri>        Адрес MongoDB, без него используется база в памяти.
+  --db=<name>          База MongoDB с рецептами и сессиями [default: benedict].
+  --recipes=<file>     JSONL с рецептами для базы в памяти.
+  --search=<backend>   Поиск рецептов: mongo или local [default: mongo].
+  --processes=<n>      Число процессов, 0 - по числу ядер [default: 0].
+  --log-level=<level>  Уровень логирования [default: WARNING].
+"""
+import json
+import multiprocessing
+import sys
+import time
+from collections import deque
+
+from docopt import docopt
+
+from logger import configure as configure_logging
+
+# Сессий в работе на один процесс пула
+WINDOW = 16
+
+# Состояние процесса пула: база и настройки, создаются в init_worker
+_worker = dict()
+
+
+def init_worker(mongo, db_name, recipes_path, search):
+    """
+    Инициализация процесса пула: у каждого процесса свой клиент MongoDB
+    (или своя база в памяти) и свой индекс рецептов.
+    """
+    from dialog import DialogHandler, recipe_index
+    from ingest import ingest
+    from memdb import MemoryDatabase
+    from mongo import run_sync
+    from pymongo import MongoClient
+
+    DialogHandler.search_backend = search
+    if mongo:
+        db = MongoClient(mongo)[db_name]
+    else:
+        db = MemoryDatabase()
+        if recipes_path:
+            with open(recipes_path) as f:
+                run_sync(ingest(db, (json.loads(line) for line in f if line.strip())))
+    if search == 'local':
+        run_sync(recipe_index.refresh(db))
+    _worker['db'] = db
+
+
+def run_session(lines):
+    """
+    Прогоняет по порядку все запросы одной сессии и возвращает строки
+    результата.
+    """
+    from alice import AliceRequest, AliceResponse
+    from dialog import DialogHandler
+
+    results = []
+    for line in lines:
+        alice_request = AliceRequest.from_json(line)
+        alice_response = AliceResponse(alice_request)
+        dialog = DialogHandler(alice_request, alice_response, _worker['db'])
+        start = time.perf_counter()
+        output = dialog.get_response()
+        seconds = time.perf_counter() - start
+        phases = dict()
+        for phase, duration in dialog.timings.phases:
+            phases[phase] = phases.get(phase, 0) + duration
+        results.append(json.dumps({
+            'session_id': alice_request.session.get('session_id'),
+            'message_id': alice_request.session.get('message_id'),
+            'command': alice_request.command,
+            'response': json.loads(output),
+            'step': dialog.step,
+            'handler': dialog.handler_name,
+            'seconds': seconds,
+            'phases': phases,
+        }, ensure_ascii=False))
+    return results
+
+
+def session_id(line):
+    return json.loads(line)['session']['session_id']
+
+
+def session_ends(path):
+    """
+    Первый проход по входному файлу: номер последней строки каждой
+    сессии. Заодно проверяет, что каждая строка - запрос Алисы, до того
+    как начнётся прогон.
+    """
+    ends = dict()
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                ends[session_id(line)] = number
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('{}:{}: not an Alice request'.format(path, number + 1))
+    return ends
+
+
+def read_sessions(path, ends):
+    """
+    Второй проход: строки каждой сессии отдаются, как только прочитана её
+    последняя строка (ends - из session_ends). Запросы разных сессий
+    могут идти вперемешку, как в журнале трафика, в памяти держатся
+    только ещё не завершённые сессии.
+    """
+    open_sessions = dict()
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            line_session_id = session_id(line)
+            open_sessions.setdefault(line_session_id, []).append(line)
+            if ends[line_session_id] == number:
+                yield open_sessions.pop(line_session_id)
+
+
+def write_results(out, results):
+    for line in results:
+        out.write(line + '\n')
+    return len(results)
+
+
+def main():
+    args = docopt(__doc__)
+    configure_logging(level=args['--log-level'])
+    processes = int(args['--processes']) or multiprocessing.cpu_count()
+    try:
+        ends = session_ends(args['<input>'])
+    except (OSError, ValueError) as e:
+        sys.exit(str(e))
+
+    # Словари pymorphy2 загружаются до запуска пула и наследуются
+    # процессами
+    from dialog import warmup
+    warmup()
+
+    start = time.perf_counter()
+    turns = sessions = 0
+    initargs = (args['--mongo'], args['--db'], args['--recipes'], args['--search'])
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=initargs) as pool, \
+            open(args['<output>'], 'w') as out:
+        # Сессий в работе не больше WINDOW на процесс, чтобы чтение
+        # входного файла не обгоняло пул
+        pending = deque()
+        for lines in read_sessions(args['<input>'], ends):
+            pending.append(pool.apply_async(run_session, (lines,)))
+            sessions += 1
+            while pending and (len(pending) >= WINDOW * processes or pending[0].ready()):
+                turns += write_results(out, pending.popleft().get())
+        while pending:
+            turns += write_results(out, pending.popleft().get())
+    elapsed = time.perf_counter() - start
+    print('{} turns in {} sessions, {:.1f}s, {:.0f} turns/s'.format(turns, sessions, elapsed,
+                                                                     turns / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Нагрузочный тест навыка. Из примеров запросов Алисы собираются
+многоходовые диалоги (поиск, выбор рецепта, несколько шагов "дальше",
+вопрос о калориях), которые параллельно проигрываются против локально
+запущенного make_app(). Результат - пропускная способность, p50/p95/p99
+по типам ходов и число запросов к MongoDB на ход - сохраняется в JSON
+для сравнения версий.
+
+Usage:
+  bench.py [--transcripts=<file>] [--recipes=<file>] [--mongo=<uri>] [--search=<backend>] [--prefetch]
+           [--dialogs=<n>] [--concurrency=<n>] [--steps=<n>] [--port=<port>] [--output=<file>]
+  bench.py -h | --help
+
+Options:
+  -h --help             Показать эту справку.
+  --transcripts=<file>  Примеры запросов и ответов Алисы [default: exmpl.txt].
+  --recipes=<file>      JSONL с рецептами для базы в памяти, иначе рецепты генерируются.
+  --mongo=<uri>         Использовать MongoDB по этому адресу вместо базы в памяти.
+  --search=<backend>    Поиск рецептов: mongo или local [default: mongo].
+  --prefetch            Включить загрузку рецептов следующего хода после ответа.
+  --dialogs=<n>         Сколько диалогов проиграть [default: 200].
+  --concurrency=<n>     Сколько диалогов идёт одновременно [default: 20].
+  --steps=<n>           Сколько раз в диалоге сказать "дальше" [default: 3].
+  --port=<port>         Порт тестового сервера, /metrics - на port + 1 [default: 8089].
+  --output=<file>       Файл для результатов [default: bench.json].
+"""
+import asyncio
+import copy
+import json
+import multiprocessing
+import random
+import re
+import subprocess
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from docopt import docopt
+
+# Запросы, которые добавляются к найденным в примерах
+SEARCH_COMMANDS = [
+    'что приготовить из кабачков',
+    'что приготовить из курицы',
+    'что приготовить из курицы без грибов',
+    'что приготовить из картофеля и сыра',
+    'что приготовить из риса без лука',
+    'как приготовить борщ',
+    'как приготовить плов',
+    'подскажи рецепт запеканки',
+]
+INGREDIENTS = ['кабачки', 'курица', 'грибы', 'картофель', 'сыр', 'рис', 'говядина', 'лук', 'морковь',
+               'помидоры', 'свекла', 'капуста', 'тыква', 'фасоль', 'лосось', 'яйца']
+DISHES = ['Суп', 'Салат', 'Рагу', 'Запеканка', 'Котлеты', 'Паста', 'Пирог', 'Омлет', 'Борщ', 'Плов']
+TEMPLATE = {
+    'meta': {'locale': 'ru-RU', 'timezone': 'UTC', 'interfaces': {'screen': {}}},
+    'request': {'command': '', 'original_utterance': '', 'type': 'SimpleUtterance',
+                'nlu': {'tokens': [], 'entities': []}},
+    'session': {'message_id': 0, 'new': True, 'session_id': '', 'skill_id': 'bench', 'user_id': ''},
+    'version': '1.0',
+}
+
+
+def load_transcripts(path):
+    """
+    Вытаскивает из файла с примерами JSON запросы, идущие после "Request:".
+    """
+    with open(path) as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    requests = []
+    for match in re.finditer(r'Request:\s*', text):
+        try:
+            request, _ = decoder.raw_decode(text, match.end())
+        except ValueError:
+            continue
+        requests.append(request)
+    return requests
+
+
+def make_request(template, session_id, user_id, message_id, command, number=None):
+    request = copy.deepcopy(template)
+    request['request']['command'] = command
+    request['request']['original_utterance'] = command
+    request['request']['nlu']['tokens'] = command.split()
+    entities = []
+    if number is not None:
+        entities.append({'type': 'YANDEX.NUMBER', 'value': number,
+                         'tokens': {'start': 0, 'end': 1}})
+    request['request']['nlu']['entities'] = entities
+    request['session'].update({'session_id': session_id, 'user_id': user_id,
+                               'message_id': message_id, 'new': message_id == 0})
+    return request
+
+
+def make_scripts(searches, dialogs, steps, seed=0):
+    """
+    Сценарии диалогов: список ходов (тип хода, фраза, число).
+    """
+    rnd = random.Random(seed)
+    scripts = []
+    for _ in range(dialogs):
+        script = [('welcome', '', None), ('search', rnd.choice(searches), None),
+                  ('pick', 'первый', 1)]
+        script.extend(('step', 'дальше', None) for _ in range(steps))
+        script.append(('nutrients', 'сколько калорий', None))
+        scripts.append(script)
+    return scripts
+
+
+def generate_recipes(count=500, seed=0):
+    rnd = random.Random(seed)
+    recipes = []
+    for i in range(count):
+        ingredients = rnd.sample(INGREDIENTS, rnd.randint(2, 5))
+        recipes.append({
+            'title': '{} {} №{}'.format(rnd.choice(DISHES), ingredients[0], i),
+            'ingredients': [{'name': name, 'amount': '{} г'.format(rnd.randint(1, 10) * 50)}
+                            for name in ingredients],
+            'steps': ['Шаг {}: {}.'.format(n + 1, name) for n, name in enumerate(ingredients * 2)],
+            'nutrients': [{'name': name, 'amount': rnd.randint(1, 300), 'unit': unit}
+                          for name, unit in (('Калорийность', 'ккал'), ('Белки', 'г'),
+                                             ('Жиры', 'г'), ('Углеводы', 'г'))],
+            'portions': '{} порции'.format(rnd.randint(2, 4)),
+            'time': '{} минут'.format(rnd.randint(2, 12) * 10),
+        })
+    return recipes
+
+
+def serve(port, mongo, search, prefetch, recipes, ready):
+    """
+    Тестовый сервер в отдельном процессе, чтобы нагрузка и навык не
+    делили одно ядро.
+    """
+    import tornado.ioloop
+    from dialog import DialogHandler, recipe_index, warmup
+    from ingest import ingest
+    from memdb import MemoryDatabase
+    from mongo import run_sync
+    from server import make_admin_app, make_app, make_db
+
+    warmup()
+    DialogHandler.search_backend = search
+    DialogHandler.prefetch_recipes = prefetch
+    if mongo:
+        db = make_db(mongo)
+    else:
+        db = MemoryDatabase()
+        run_sync(ingest(db, recipes))
+    if search == 'local':
+        tornado.ioloop.IOLoop.current().run_sync(lambda: recipe_index.refresh(db))
+    make_app(db).listen(port)
+    make_admin_app(db).listen(port + 1, address='127.0.0.1')
+    ready.set()
+    tornado.ioloop.IOLoop.current().start()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+    }
+
+
+def parse_mongo_ops(metrics_text):
+    """
+    Считает по /metrics среднее число запросов к MongoDB на ход для
+    каждого хендлера.
+    """
+    turns = dict()
+    ops = defaultdict(dict)
+    pattern = re.compile(r'benedict_phase_seconds_count\{phase="([^"]*)",step="[^"]*",handler="([^"]*)"\} (\S+)')
+    for phase, handler, value in pattern.findall(metrics_text):
+        if phase == 'session_load':
+            turns[handler] = turns.get(handler, 0) + float(value)
+        elif phase.startswith('mongo.'):
+            ops[handler][phase[len('mongo.'):]] = ops[handler].get(phase[len('mongo.'):], 0) + float(value)
+    return {handler: {op: count / turns[handler] for op, count in handler_ops.items()}
+            for handler, handler_ops in ops.items() if turns.get(handler)}
+
+
+async def run(scripts, template, url, admin_url, concurrency):
+    from tornado.httpclient import AsyncHTTPClient
+
+    AsyncHTTPClient.configure(None, max_clients=concurrency)
+    client = AsyncHTTPClient()
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    queue = list(reversed(scripts))
+
+    async def worker():
+        while queue:
+            script = queue.pop()
+            session_id, user_id = str(uuid.uuid4()), str(uuid.uuid4())
+            for message_id, (turn, command, number) in enumerate(script):
+                body = json.dumps(make_request(template, session_id, user_id, message_id, command, number))
+                start = time.perf_counter()
+                try:
+                    await client.fetch(url + '/benedict', method='POST', body=body)
+                except Exception:
+                    errors[turn] += 1
+                    break
+                latencies[turn].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    metrics = await client.fetch(admin_url + '/metrics')
+    return latencies, errors, elapsed, metrics.body.decode()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = docopt(__doc__)
+    port = int(args['--port'])
+    transcripts = load_transcripts(args['--transcripts'])
+    template = transcripts[0] if transcripts else TEMPLATE
+    searches = [r['request']['command'] for r in transcripts if ' из ' in ' {} '.format(r['request']['command'])
+                or 'рецепт' in r['request']['command'] or 'приготовить' in r['request']['command']]
+    scripts = make_scripts(searches + SEARCH_COMMANDS, int(args['--dialogs']), int(args['--steps']))
+    if args['--recipes']:
+        with open(args['--recipes']) as f:
+            recipes = [json.loads(line) for line in f if line.strip()]
+    else:
+        recipes = generate_recipes()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, daemon=True,
+                                     args=(port, args['--mongo'], args['--search'], args['--prefetch'], recipes, ready))
+    server.start()
+    try:
+        ready.wait(60)
+        latencies, errors, elapsed, metrics = asyncio.get_event_loop().run_until_complete(
+            run(scripts, template, 'http://127.0.0.1:{}'.format(port), 'http://127.0.0.1:{}'.format(port + 1),
+                int(args['--concurrency'])))
+    finally:
+        server.terminate()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat(),
+        'config': {key.lstrip('-'): value for key, value in args.items() if key.startswith('--')},
+        'database': 'mongodb' if args['--mongo'] else 'memory',
+        'elapsed': elapsed,
+        'turns': len(all_latencies),
+        'throughput': len(all_latencies) / elapsed if elapsed else None,
+        'latency': summarize(all_latencies),
+        'latency_by_turn': {turn: summarize(values) for turn, values in latencies.items()},
+        'errors': dict(errors),
+        'mongo_ops_per_turn': parse_mongo_ops(metrics),
+    }
+    with open(args['--output'], 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print('{} turns in {:.1f}s, {:.0f} turns/s, p50 {:.1f} ms, p99 {:.1f} ms'.format(
+        result['turns'], elapsed, result['throughput'] or 0,
+        (result['latency']['p50'] or 0) * 1000, (result['latency']['p99'] or 0) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Словарь ограниченного размера с вытеснением давно не использованных
+    ключей, необязательным временем жизни записей (ttl, в секундах) и
+    счётчиками попаданий, промахов и вытеснений.
+    Устаревшие записи остаются в кэше до вытеснения или перезаписи и
+    доступны через get(key, stale=True), когда свежих данных получить не
+    удалось.
+    """
+    missing = object()
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None, stale=False):
+        item = self._data.get(key, self.missing)
+        if stale:
+            # Запасной путь, в статистике попаданий не учитывается
+            return default if item is self.missing else item[0]
+        if item is self.missing:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """
+        Свежее значение без учёта в статистике и без изменения порядка
+        вытеснения, default - если записи нет или она устарела.
+        """
+        item = self._data.get(key, self.missing)
+        if item is self.missing:
+            return default
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            return default
+        return value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -1,51 +1,103 @@
-from pymorphy2 import MorphAnalyzer
+from pymongo import ReturnDocument
 from logger import get_logger
+from matcher import IntentMatcher
+from metrics import Timings, TimedDatabase, StatsGauges, degradations, registry
+from morphology import LemmaCache, NumberAgreement, inflect_phrase, morphology
+from mongo import resolve, fetch_all, run_sync, fire_and_forget, DeadlineDatabase, DeadlineExceeded
+from recipes import recipe_cache, recipes_watcher
+from search import RecipeIndex, SearchCache
+from sessions import session_store
 import random
+from datetime import datetime
 
 log = get_logger(app_name='dialog')
-morph = MorphAnalyzer()
+# Сколько рецептов называется за один раз
+PAGE_SIZE = 3
+# Сколько первых результатов поиска загружается сразу: по ним называется
+# число найденных рецептов и выбирается рецепт по названию
+LOOKAHEAD = 12
+morph = morphology
+lemmas = LemmaCache(morph)
+agreement = NumberAgreement(morph)
+recipe_index = RecipeIndex(lemmas)
+search_cache = SearchCache(lemmas)
+recipes_watcher.subscribe(search_cache.invalidate)
+
+registry.register(StatsGauges('benedict_morphology', 'Morphology engine', morph.stats))
+registry.register(StatsGauges('benedict_lemma_cache', 'Lemma cache', lemmas.stats))
+registry.register(StatsGauges('benedict_recipe_cache', 'Recipe document cache', recipe_cache.stats))
+registry.register(StatsGauges('benedict_search_cache', 'Search result cache', search_cache.stats))
+registry.register(StatsGauges('benedict_session_store', 'Session store', session_store.stats))
 
 
 def normalize(obj):
     if type(obj) == str:
         obj = obj.split(' ')
-    return [morph.parse(word)[0].normal_form for word in obj]
-
-
-def choose_closest(tokens, choices):
-    tokens = normalize(tokens)
-    score = dict()
-    for choice in choices:
-        score[choice] = 0
-        normalized_choice = normalize(choice)
-        for word in normalized_choice:
-            if word in tokens:
-                score[choice] += 1
-            else:
-                score[choice] -= 0.1
-    t = [(k, v) for k, v in score.items()]
-    t.sort(key=lambda x: x[1])
-    if t[-1][1] == 0:
-        return None
-    return t[-1][0]
+    return lemmas.normalize_many(obj)
+
+
+def text_query(include, exclude=()):
+    """
+    Строка $search для полнотекстового поиска MongoDB.
+    """
+    query = ' '.join(include)
+    if exclude:
+        query = '{} -{}'.format(query, ' -'.join(exclude))
+    return query
+
+
+def title_lemmas(title):
+    """
+    Леммы слов названия рецепта для выбора рецепта из списка найденных.
+    """
+    return sorted(set(normalize(title)))
+
+
+def choose_closest(tokens, choices, preferred=()):
+    """
+    Выбирает из choices (документы результатов поиска) название, лучше
+    всего совпадающее со словами запроса: +1 за каждое слово названия из
+    запроса, -0.1 за каждое отсутствующее. Названия без общих с запросом
+    слов не выбираются. При равенстве выигрывают названия с индексами из
+    preferred, затем стоящие раньше.
+    Леммы названий берутся из поля lemmas, которое search_recipes
+    заполняет при сохранении результатов.
+    """
+    tokens = set(normalize(tokens))
+    best, best_key = None, None
+    for i, choice in enumerate(choices):
+        words = choice.get('lemmas')
+        if words is None:
+            words = title_lemmas(choice['title'])
+        matched = len(tokens.intersection(words))
+        if not matched:
+            continue
+        key = (matched - 0.1 * (len(words) - matched), i in preferred, -i)
+        if best_key is None or key > best_key:
+            best, best_key = choice['title'], key
+    return best
 
 
 def inflect(string, inflect_to):
-    ans = []
-    transform = True
-    for i, word in enumerate(string.split(' ')):
-        w = morph.parse(word)[0].inflect({inflect_to})
-        if w and transform:
-            ans.append(w.word)
-            if 'NOUN' in w.tag:
-                transform = False
-        else:
-            ans.append(word)
-    return ' '.join(ans)
+    return inflect_phrase(morph, string, inflect_to)
+
+
+def warmup():
+    """
+    Загружает словари pymorphy2, прогревает кэш лемм словами из таблиц
+    команд и строит таблицы согласования с числительными.
+    """
+    morph.load()
+    words = set()
+    for matcher in (DialogHandler.main_matcher, DialogHandler.step_matcher,
+                    DialogHandler.recipe_list_matcher, DialogHandler.recipe_selected_matcher):
+        words |= matcher.vocabulary
+    lemmas.warmup(words)
+    agreement.table('рецепт')
 
 
 class DialogHandler:
-    morph = MorphAnalyzer()
+    morph = morphology
     main_tokens = {
         'get_recipes_count': {
             'necessary': ['рецептов'],
@@ -152,67 +204,236 @@ class DialogHandler:
         },
     }
 
-    def __init__(self, req, resp, db):
+    # Таблицы команд компилируются в индекс один раз при импорте
+    main_matcher = IntentMatcher(main_tokens)
+    step_matcher = IntentMatcher(step_tokens)
+    recipe_list_matcher = IntentMatcher(recipe_list_tokens)
+    recipe_selected_matcher = IntentMatcher(recipe_selected_tokens)
+
+    # Движок поиска рецептов: 'mongo' ($text) или 'local' (recipe_index)
+    search_backend = 'mongo'
+    # Сколько последних реплик хранится в db.history
+    history_limit = 20
+    # Писать ли полные диалоги в db.history_archive
+    archive_history = False
+    # Хранилище состояния сессий
+    sessions = session_store
+    # Источник рецептов: кэш поверх MongoDB или снимок (snapshot.py)
+    recipes = recipe_cache
+    # Загружать ли после ответа рецепты, которые понадобятся на следующем
+    # ходу (prefetch)
+    prefetch_recipes = False
+    # Шаг диалога -> поля рецептов, которые читают хендлеры этого шага
+    prefetch_fields = {
+        'recipes_list': ('ingredients', 'portions'),
+        'recipe_selected': ('ingredients', 'portions', 'steps'),
+        'recipe': ('steps', 'nutrients', 'title_forms', 'time'),
+    }
+
+    def __init__(self, req, resp, db, timings=None, deadline=None):
         self.req = req
         self.resp = resp
-        self.db = db
-        history = self.db.history.find_one({'user': self.req.user_id})
-        if history is None:
-            _id = self.db.history.insert_one({'user': self.req.user_id, 'history': list()}).inserted_id
-            history = self.db.history.find_one({'_id': _id})
+        # Длительности этапов хода, в том числе каждого запроса к базе
+        self.timings = Timings() if timings is None else timings
+        # Бюджет времени на ход (mongo.Deadline), им ограничен каждый
+        # запрос к базе. None - без ограничения.
+        self.deadline = deadline
+        if deadline is not None:
+            db = DeadlineDatabase(db, deadline)
+        self.db = TimedDatabase(db, self.timings)
+        # Шаг диалога в начале хода и выбранный хендлер - метки метрик
+        self.step = None
+        self.handler_name = None
+        self.history = None
+        self.session = None
+        # Изменения сессии за ход, записываются одним запросом в flush
+        self.session_changes = dict()
+        # Можно ли отдать ответ повторам этого запроса (см. replay.py):
+        # нельзя, если изменения сессии не сохранены
+        self.replayable = True
+
+    async def load(self):
+        """
+        Загружает историю пользователя и состояние сессии, создавая их
+        при первом обращении. Для истории - один атомарный upsert с
+        возвратом документа, из неё нужна только последняя реплика - её и
+        читаем. Сессия берётся из хранилища sessions.
+        """
+        with self.timings.measure('session_load'):
+            await self._load()
+        self.step = self.session.get('step')
+
+    async def _load(self):
+        history = await resolve(self.db.history.find_one_and_update(
+            {'user': self.req.user_id},
+            {'$setOnInsert': {'history': list()}},
+            projection={'history': {'$slice': -1}},
+            upsert=True, return_document=ReturnDocument.AFTER))
         self.history = history.get('history')
-        self.session = self.db.sessions.find_one({'session': self.req.session.get('session_id')})
-        if not self.session:
-            _id = self.db.sessions.insert_one({'session': self.req.session.get('session_id'),
-                                               'recipe': '',
-                                               'step': 'start',
-                                               'recipes_list': [],
-                                               'page': 0}).inserted_id
-            self.session = self.db.sessions.find_one({'_id': _id})
+        self.session = await self.sessions.load(self.db.sessions, self.req.session.get('session_id'))
+
+    def update_session(self, **fields):
+        """
+        Меняет состояние сессии в памяти и запоминает изменения до flush.
+        """
+        self.session.update(fields)
+        self.session_changes.update(fields)
+
+    async def flush(self):
+        """
+        Сохраняет в базу всё, что изменилось за ход: сессию и историю.
+        В историю дописывается реплика хода, длина истории ограничена
+        history_limit. Возвращает False и ничего не пишет в историю, если
+        сессию за это время изменил другой процесс.
+        Если ход изменил сессию, вместе с ней сохраняется ответ: повтор
+        запроса получит его, а не выполнит ход второй раз.
+        """
+        if self.session_changes:
+            self.update_session(reply={'message_id': self.req.session.get('message_id'),
+                                       'text': self.resp.get_text()})
+        saved = await self.sessions.save(self.db.sessions, self.req.session.get('session_id'),
+                                         self.session, self.session_changes)
+        self.session_changes = dict()
+        if not saved:
+            return False
+        turn = [self.req.command, self.resp.get_text()]
+        try:
+            await resolve(self.db.history.update_one({'user': self.req.user_id},
+                                                     {'$push': {'history': {'$each': turn,
+                                                                            '$slice': -self.history_limit}}}))
+            if self.archive_history:
+                fire_and_forget(self.db.history_archive.insert_one({'user': self.req.user_id,
+                                                                    'session': self.req.session.get('session_id'),
+                                                                    'message_id': self.req.session.get('message_id'),
+                                                                    'command': turn[0],
+                                                                    'response': turn[1],
+                                                                    'time': datetime.utcnow()}))
+        except DeadlineExceeded:
+            # Сессия уже сохранена, так что ответ остаётся в силе, теряется
+            # только реплика для "повтори"
+            degradations.inc(path='history_skipped')
+        return True
+
+    async def get_recipe(self, fields=None):
+        """
+        Возвращает выбранный в сессии рецепт из источника recipes.
+        fields - нужные поля документа, None - весь документ.
+        """
+        try:
+            return await self.recipes.get(self.db.recipes, self.session.get('recipe'), fields)
+        except DeadlineExceeded:
+            recipe = self.recipes.get_stale(self.session.get('recipe'), fields)
+            if recipe is None:
+                raise
+            degradations.inc(path='stale_recipe')
+            return recipe
+
+    async def prefetch(self, db):
+        """
+        Заранее загружает в источник рецептов то, что скорее всего
+        понадобится на следующем ходу: рецепты текущей страницы списка или
+        выбранный рецепт. Вызывается после отправки ответа, с базой без
+        учёта времени хода и без deadline.
+        """
+        step = self.session.get('step') if self.session else None
+        fields = self.prefetch_fields.get(step)
+        if fields is None:
+            return
+        try:
+            if step == 'recipes_list':
+                titles = await self.page_titles(self.session.get('page', 0), db)
+            else:
+                titles = [self.session.get('recipe')]
+            await self.recipes.prefetch(db.recipes, titles, fields)
+        except Exception as e:
+            # Ответ уже отправлен, следующий ход загрузит рецепты сам
+            log.warning('Prefetch failed: %s: %s', type(e).__name__, e)
 
     def get_response(self):
+        """
+        Синхронная обёртка над get_response_async для pymongo.
+        """
+        return run_sync(self.get_response_async())
+
+    def replay(self):
+        """
+        Если запрос с этим message_id уже изменил сессию, отвечает
+        сохранённым ответом и возвращает True.
+        """
+        reply = self.session.get('reply')
+        if not reply or reply.get('message_id') != self.req.session.get('message_id'):
+            return False
+        self.resp.set_text(reply['text'])
+        self.handler_name = 'replay'
+        return True
+
+    async def get_response_async(self):
         """
         Тут реализована логика обработки запроса.
+        Если время на ход (deadline) вышло, изменения сессии не
+        сохраняются, а пользователя просят повторить запрос.
         """
+        try:
+            if self.session is None:
+                await self.load()
+            if not self.replay():
+                await self.process()
+                if not await self.flush():
+                    # Ход обработан по устаревшему состоянию сессии -
+                    # повторяем его один раз с состоянием из базы, если
+                    # это не был повтор того же запроса
+                    log.info('Session %s was changed concurrently, retrying', self.req.session.get('session_id'))
+                    await self.load()
+                    if not self.replay():
+                        await self.process()
+                        self.replayable = await self.flush()
+        except DeadlineExceeded:
+            log.warning('Deadline exceeded in session %s', self.req.session.get('session_id'))
+            degradations.inc(path='retry_reply')
+            self.session_changes = dict()
+            self.replayable = False
+            self.resp.set_text('Извините, я задумался. Повторите, пожалуйста.')
+        with self.timings.measure('serialize'):
+            return self.resp.dumps()
+
+    async def process(self):
         if not self.req.is_new_session:
             self.resp.set_text('Извините, я вас не совсем понял. Не могли бы переформулировать.')
-            self.process_req()
+            await self.process_req()
         else:
             # Обрабатываем запрос от нового пользователя.
             if self.req.command == '':
                 self.resp.set_text('Здравствуйте! Я могу подобрать рецепт по ингредиентам и продиктовать пошаговые '
                                    'инструкции по приготовлению. Просто спросите "Что приготовить из шампиньонов?" или '
                                    '"Как приготовить карбонару?"')
+                self.handler_name = 'welcome'
             else:
-                self.process_req()
-        self.history.extend([self.req.command, self.resp.get_text()])
-        self.db.history.update_one({'user': self.req.user_id},
-                                   {'$set': {'history': self.history}})
-        return self.resp.dumps()
+                await self.process_req()
 
-    def unknown(self):
+    async def unknown(self):
         choices = ['Извините, я вас не совсем понял. Не могли бы переформулировать.']
         self.resp.set_text(random.choice(choices))
 
-    def choose_recipe(self):
-        page = self.session.get('page')
-        idx = page * 3
+    async def choose_recipe(self):
         num = self.req.get_number()
-        recipes_page = self.session.get('recipes_list')[idx:idx+3]
+        page = self.session.get('page')
+        recipes_page = await self.page_titles(page)
         if num and num < len(recipes_page):
             recipe_title = recipes_page[num - 1]
         else:
-            recipe_title = choose_closest(self.req.tokens, recipes_page)
-            log.debug('choosen recipe is {}, list is {}'.format(recipe_title,
-                                                                recipes_page))
+            # Название ищется среди всех рецептов, которые пользователь
+            # уже слышал, при равенстве выигрывает текущая страница
+            offered = await self.offered_recipes()
+            current = range(page * PAGE_SIZE, page * PAGE_SIZE + len(recipes_page))
+            with self.timings.measure('morphology'):
+                recipe_title = choose_closest(self.req.tokens, offered, preferred=current)
+            log.debug('choosen recipe is %s, list is %s', recipe_title, [recipe['title'] for recipe in offered])
             if recipe_title is None:
-                return self.get_help_rec_list()
-        self.session['recipe'] = recipe_title
-        self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                    {'$set': {'recipe': recipe_title, 'step': 'recipe_selected', 'page': -1}})
-        self.start_recipe()
+                return await self.get_help_rec_list()
+        self.update_session(recipe=recipe_title, step='recipe_selected', page=-1)
+        await self.start_recipe()
 
-    def process_req(self):
+    async def process_req(self):
         """
         Вызов функции хендлера по токенам.
         У каждой команды есть 2 списка токенов - обязательные и дополнительные.
@@ -225,86 +446,141 @@ class DialogHandler:
         """
         tokens = self.req.tokens
         step = self.session.get('step')
-        log.debug('current step is {}'.format(step))
+        log.debug('current step is %s', step)
         if step == 'recipes_list':
-            self.process_tokens(tokens, self.recipe_list_tokens, default=self.choose_recipe)
+            await self.process_tokens(tokens, self.recipe_list_matcher, default=self.choose_recipe)
         elif step == 'recipe':
-            self.process_tokens(tokens, self.step_tokens, default=self.get_help_step)
+            await self.process_tokens(tokens, self.step_matcher, default=self.get_help_step)
         elif step == 'recipe_selected':
-            self.process_tokens(tokens, self.recipe_selected_tokens, default=self.get_help_rec_sel)
+            await self.process_tokens(tokens, self.recipe_selected_matcher, default=self.get_help_rec_sel)
         else:
-            self.process_tokens(tokens, self.main_tokens, default=self.get_help_main)
-
-    def process_tokens(self, tokens, token_list, default):
-        for handler, target_tokens in token_list.items():
-            # Ищем необходимые для проверяемой команды токены, если они есть
-            if len(target_tokens.get('necessary', [])):
-                for n_token in target_tokens['necessary']:
-                    if n_token in tokens:
-                        break
-                else:
-                    # Если не нашли - переходим к проверке следующей команды
-                    continue
-
-            # Проверяем, присутствет ли хотя бы один токен из
-            # списка дополнительных токенов (должен быть хотя бы один),
-            # если они есть
-            if len(target_tokens.get('one_of', [])):
-                for o_token in target_tokens['one_of']:
-                    if type(o_token) is list:
-                        # Если элемент дополнительных токенов - список, то
-                        # проверяем, что все элементы этого списка присутствуют
-                        # в токенах запроса
-                        for o_token_item in o_token:
-                            if o_token_item not in tokens:
-                                break
-                        else:
-                            # Если хотя все элементы из списка дополнительных
-                            # токенов были найдены - заканчиваем проверку (ключ
-                            # нужной команды найден)
-                            break
-                    if o_token in tokens:
-                        # Если хоть один из дополнительных токенов найдет -
-                        # заканчиваем проверку (ключ нужной команды найден)
-                        break
-                else:
-                    # Если ни один из дополнительных токенов не был найден -
-                    # переходим к проверке следующей команды
-                    continue
-            # Все (обязательные и дополнительные) токены были найдены в
-            # списке токенов запроса - вызываем хендлер
-            log.debug('Choosen handler is {}'.format(handler))
-            getattr(self, handler, default)()
+            await self.process_tokens(tokens, self.main_matcher, default=self.get_help_main)
+
+    async def process_tokens(self, tokens, matcher, default):
+        with self.timings.measure('intent_match'):
+            handler = matcher.match(tokens)
+        if handler is None or not hasattr(self, handler):
+            self.handler_name = default.__name__
+            await default()
             return
-        default()
+        self.handler_name = handler
+        # Все (обязательные и дополнительные) токены были найдены в
+        # списке токенов запроса - вызываем хендлер
+        log.debug('Choosen handler is %s', handler)
+        await getattr(self, handler)()
 
-    def resp_from_recipe_list(self, recipe_list):
+    async def resp_from_recipe_list(self, recipe_list, query):
+        """
+        Отвечает списком найденных рецептов. recipe_list - не более
+        LOOKAHEAD + 1 первых результатов, query - запрос ({'include': ...,
+        'exclude': ...}), по которому загружаются страницы списка.
+        В сессии остаются только запрос, число найденных рецептов (None -
+        больше LOOKAHEAD), номер текущей страницы и самой дальней из
+        показанных (max_page).
+        """
         titles = [recipe.get('title') for recipe in recipe_list]
         if len(titles) == 0:
             resp = 'К сожалению, я не знаю такого рецепта. Давайте поищем что нибудь другое.'
-            self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                        {'$set': {'step': 'start'}})
+            self.update_session(step='start')
         elif len(titles) == 1:
-            self.db.sessions.update_one(
-                {'session': self.req.session.get('session_id')},
-                {'$set':
-                     {'recipe': titles[-1],
-                      'step': 'recipe_selected'}})
+            self.update_session(recipe=titles[-1], step='recipe_selected')
             resp = 'Я нашел для вас рецепт {}. Приступаем?'.format(titles[-1])
-
-        elif len(titles) > 3:
-            rec = morph.parse('рецепт')[0].make_agree_with_number(len(titles)).word
-            resp = 'Я нашел для вас {} {}. Самые популярные это {}. Что нибудь понравилось или ищем дальше?'.format(
-                len(titles), rec, ', '.join(titles[:3]))
-            self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                        {'$set': {'recipes_list': titles, 'step': 'recipes_list', 'page': 0}})
         else:
-            resp = 'Я нашел для вас следующие рецепты: {}. Что будем готовить?'.format(', '.join(titles[:3]))
-            self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                        {'$set': {'recipes_list': titles, 'step': 'recipes_list', 'page': 0}})
+            total = len(titles) if len(titles) <= LOOKAHEAD else None
+            if total is None:
+                rec = agreement.agree('рецепт', LOOKAHEAD)
+                resp = 'Я нашел для вас больше {} {}. Самые популярные это {}. ' \
+                       'Что нибудь понравилось или ищем дальше?'.format(LOOKAHEAD, rec, ', '.join(titles[:PAGE_SIZE]))
+            elif total > PAGE_SIZE:
+                rec = agreement.agree('рецепт', total)
+                resp = 'Я нашел для вас {} {}. Самые популярные это {}. ' \
+                       'Что нибудь понравилось или ищем дальше?'.format(total, rec, ', '.join(titles[:PAGE_SIZE]))
+            else:
+                resp = 'Я нашел для вас следующие рецепты: {}. Что будем готовить?'.format(', '.join(titles))
+            self.update_session(step='recipes_list', page=0, max_page=0, query=query, total=total)
         self.resp.set_text(resp)
 
-    def get_recipe_by_name(self):
+    async def query_recipes(self, skip, limit, db=None):
+        """
+        Рецепты с skip по skip + limit из результатов запроса сессии.
+        Первые LOOKAHEAD результатов берутся из того же списка, что
+        загружен при поиске, дальше - постранично, и те, и другие через
+        search_cache. db - база для поиска, по умолчанию база хода.
+        """
+        query = self.session.get('query')
+        if query is None:
+            # Сессия, сохранённая со всем списком найденных рецептов
+            return [{'title': title} for title in (self.session.get('recipes_list') or [])[skip:skip + limit]]
+        if skip + limit <= LOOKAHEAD:
+            recipe_list = await self.search_recipes(query['include'], query['exclude'], limit=LOOKAHEAD + 1, db=db)
+            return recipe_list[skip:skip + limit]
+        return await self.search_recipes(query['include'], query['exclude'], limit=limit, skip=skip, db=db)
+
+    async def page_titles(self, page, db=None):
+        return [recipe.get('title') for recipe in await self.query_recipes(page * PAGE_SIZE, PAGE_SIZE, db)]
+
+    async def offered_recipes(self):
+        """
+        Все рецепты, которые пользователь уже слышал: страницы с первой по
+        max_page. Страницы берутся через search_cache, куда они попали,
+        когда их называли.
+        """
+        if self.session.get('query') is None:
+            return await self.query_recipes(0, len(self.session.get('recipes_list') or []))
+        page = self.session.get('page')
+        recipes = []
+        for offered_page in range(max(self.session.get('max_page', page), page) + 1):
+            recipes.extend(await self.query_recipes(offered_page * PAGE_SIZE, PAGE_SIZE))
+        return recipes
+
+    async def search_recipes(self, include, exclude=(), limit=PAGE_SIZE, skip=0, db=None):
+        """
+        Ищет рецепты по словам include без слов exclude движком
+        search_backend. Возвращает список не более чем из limit документов
+        с полем title, пропустив первые skip.
+        Популярные запросы отдаются из общего кэша search_cache.
+        db - база для поиска, по умолчанию база хода (с deadline).
+        """
+        db = self.db if db is None else db
+        with self.timings.measure('morphology'):
+            key = search_cache.key(self.search_backend, include, exclude, limit, skip)
+        recipe_list = search_cache.get(key)
+        if recipe_list is not None:
+            return recipe_list
+        if self.search_backend == 'local':
+            with self.timings.measure('local_search'):
+                recipe_list = recipe_index.search(include, exclude, limit, skip)
+        else:
+            try:
+                cursor = db.recipes.find({'$text': {'$search': text_query(include, exclude)}},
+                                         {'title': True, 'score': {'$meta': "textScore"}}).sort(
+                                             [('score', {'$meta': "textScore"}), ('title', 1)]
+                                         ).skip(skip).limit(limit)
+                recipe_list = await fetch_all(cursor, limit)
+            except DeadlineExceeded:
+                # Не успели - отдаём устаревший результат того же запроса
+                recipe_list = search_cache.get(key, stale=True)
+                if recipe_list is None:
+                    raise
+                degradations.inc(path='stale_search')
+                return recipe_list
+        with self.timings.measure('morphology'):
+            # Леммы названий считаются один раз, при сохранении результатов
+            for recipe in recipe_list:
+                recipe['lemmas'] = title_lemmas(recipe.get('title'))
+        search_cache.put(key, recipe_list)
+        return recipe_list
+
+    async def find_recipes(self, include, exclude=()):
+        """
+        Ищет рецепты и отвечает первой страницей результатов. Один запрос
+        к базе загружает LOOKAHEAD + 1 результат: первые страницы, число
+        найденных (или "больше LOOKAHEAD") и названия для выбора рецепта.
+        """
+        recipe_list = await self.search_recipes(include, exclude, limit=LOOKAHEAD + 1)
+        await self.resp_from_recipe_list(recipe_list, {'include': list(include), 'exclude': list(exclude)})
+
+    async def get_recipe_by_name(self):
         tokens = self.req.tokens
         if 'рецепт' in tokens:
             ind = tokens.index('рецепт')
@@ -313,39 +589,23 @@ class DialogHandler:
         elif 'готовить' in tokens:
             ind = tokens.index('готовить')
 
-        recipe_tokens = ' '.join(tokens[ind + 1:])
-        recipe_list = self.db.recipes.find(
-            {'$text': {'$search': recipe_tokens}},
-            {'score': {'$meta': "textScore"}}).sort(
-            [('score', {'$meta': "textScore"})]).limit(10)
+        await self.find_recipes(tokens[ind + 1:])
 
-        self.resp_from_recipe_list(recipe_list)
-
-    def get_recipe_by_ingredients(self):
+    async def get_recipe_by_ingredients(self):
         tokens = self.req.tokens
         ind = tokens.index('из')
         if 'без' in tokens:
             ind_2 = tokens.index('без')
             include_ingr = tokens[ind + 1: ind_2]
             exclude_ingr = tokens[ind_2 + 1:]
-            if len(exclude_ingr) == 1:
-                exclude_ingr = ' -' + exclude_ingr[0]
-            else:
-                exclude_ingr = ' -'.join(exclude_ingr)
-            recipe_list = self.db.recipes.find({'$text': {'$search': (' '.join(include_ingr) + exclude_ingr)}},
-                                               {'score': {'$meta': "textScore"}}).sort(
-                                                   [('score', {'$meta': "textScore"})]).limit(12)
         else:
             include_ingr = tokens[ind + 1:]
-            recipe_list = self.db.recipes.find({'$text': {'$search': ' '.join(include_ingr)}},
-                                               {'score': {'$meta': "textScore"}}).sort(
-                                                   [('score', {'$meta': "textScore"})]).limit(12)
+            exclude_ingr = []
 
-        self.resp_from_recipe_list(recipe_list)
+        await self.find_recipes(include_ingr, exclude_ingr)
 
-    def start_recipe(self):
-        recipe_title = self.session.get('recipe')
-        recipe = self.db.recipes.find_one({'title': recipe_title})
+    async def start_recipe(self):
+        recipe = await self.get_recipe(('ingredients', 'portions'))
         title = recipe.get('title')
         ingredients = recipe.get('ingredients')
         ingrs_str = ''
@@ -354,37 +614,33 @@ class DialogHandler:
         portions = recipe.get('portions')
         resp = "Готовим {}. Чтобы приготовить {} Вам понадобится: {}. Приступаем?".format(title, portions, ingrs_str)
         self.resp.set_text(resp)
-        self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                    {'$set': {'step': 'recipe', 'page': -1}})
+        self.update_session(step='recipe', page=-1)
 
-    def recipe_step_forward(self):
-        recipe = self.db.recipes.find_one({'title': self.session.get('recipe')})
+    async def recipe_step_forward(self):
+        recipe = await self.get_recipe(('steps',))
         step_num = self.session.get('page') + 1
         steps = recipe.get('steps')
         if len(steps) == step_num:
             self.resp.set_text('Готово! Приятного аппетита! Чем я еще могу Вам помочь?')
-            self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                        {'$set': {'step': 'start'}})
+            self.update_session(step='start')
         else:
             self.resp.set_text(steps[step_num])
-            self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                        {'$set': {'page': step_num}})
+            self.update_session(page=step_num)
 
-    def recipe_step_backward(self):
-        recipe = self.db.recipes.find_one({'title': self.session.get('recipe')})
+    async def recipe_step_backward(self):
+        recipe = await self.get_recipe(('steps',))
         step_num = self.session.get('page') - 1
         if step_num < 0:
             step_num = 0
         steps = recipe.get('steps')
         self.resp.set_text(steps[step_num])
-        self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                    {'$set': {'page': step_num}})
+        self.update_session(page=step_num)
 
-    def nutrients(self):
-        recipe = self.db.recipes.find_one({'title': self.session.get('recipe')})
+    async def nutrients(self):
+        recipe = await self.get_recipe(('nutrients', 'title_forms'))
         title = recipe.get('title')
         if not title:
-            return self.get_help_step()
+            return await self.get_help_step()
         nutrs = recipe.get('nutrients')
         for nutr in nutrs:
             if nutr['name'] == 'Калорийность':
@@ -396,80 +652,80 @@ class DialogHandler:
             elif nutr['name'] == 'Углеводы':
                 carb = '{} {} '.format(nutr['amount'], nutr['unit'])
 
+        # Формы названия считаются при загрузке рецептов (ingest.py), на
+        # лету склоняются только рецепты, загруженные раньше
+        title_gent = (recipe.get('title_forms') or {}).get('gent')
+        if title_gent is None:
+            with self.timings.measure('morphology'):
+                title_gent = inflect(title, 'gent')
         self.resp.set_text('В одной порции {} содержится {},'
-                           ' {} белков, {} жиров, {} углеводов'.format(inflect(title, 'gent'),
-                                                                       cal, prot, fat, carb))
+                           ' {} белков, {} жиров, {} углеводов'.format(title_gent, cal, prot, fat, carb))
 
-    def next_recipes_page(self):
-        titles = self.session.get('recipes_list')
+    async def next_recipes_page(self):
         page = self.session.get('page') + 1
-        if page * 3 >= len(titles):
+        total = self.session.get('total')
+        titles = []
+        if total is None or page * PAGE_SIZE < total:
+            titles = await self.page_titles(page)
+        if not titles:
             page = 0
-            resp = 'Мы уже пошли по второму кругу. {}.'.format(', '.join(titles[:3]))
+            resp = 'Мы уже пошли по второму кругу. {}.'.format(', '.join(await self.page_titles(page)))
         else:
-            idx = page*3
-            resp = '{}.'.format(', '.join(titles[idx:idx+3]))
-        self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                    {'$set': {'page': page}})
+            resp = '{}.'.format(', '.join(titles))
+        self.update_session(page=page, max_page=max(page, self.session.get('max_page', page)))
         self.resp.set_text(resp)
 
-    def prev_recipes_page(self):
-        titles = self.session.get('recipes_list')
-        page = self.session.get('page') - 1
-        if page < 0:
-            page += 1
-        idx = page * 3
-        resp = '{}.'.format(', '.join(titles[idx:idx + 3]))
-        self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                    {'$set': {'page': page}})
+    async def prev_recipes_page(self):
+        page = max(self.session.get('page') - 1, 0)
+        resp = '{}.'.format(', '.join(await self.page_titles(page)))
+        self.update_session(page=page)
         self.resp.set_text(resp)
 
-    def get_recipes_count(self):
-        rec_count = self.db.recipes.count_documents({})
-        rec = morph.parse('рецепт')[0].make_agree_with_number(rec_count).word
+    async def get_recipes_count(self):
+        rec_count = await resolve(self.db.recipes.count_documents({}))
+        rec = agreement.agree('рецепт', rec_count)
         self.resp.set_text('На данный момент я знаю {} {}!'.format(rec_count, rec))
 
-    def hello(self):
+    async def hello(self):
         self.resp.set_text('Здравствуйте! Чем я могу Вам помочь?')
 
-    def thank(self):
+    async def thank(self):
         self.resp.set_text('Пожалуйста! Чем ещё я могу Вам помочь?')
 
-    def stop(self):
+    async def stop(self):
         self.resp.set_text('Хорошо! Чем я еще могу Вам помочь?')
-        self.db.sessions.update_one({'session': self.req.session.get('session_id')},
-                                    {'$set': {'step': 'start'}})
+        self.update_session(step='start')
 
-    def time(self):
-        recipe = self.db.recipes.find_one({'title': self.session.get('recipe')})
+    async def time(self):
+        recipe = await self.get_recipe(('time',))
         t = recipe.get('time')
         self.resp.set_text('Время приготовления {}'.format(t))
 
-    def get_help_main(self):
+    async def get_help_main(self):
         self.resp.set_text('Я могу подобрать рецепт по ингредиентам и продиктовать пошаговые инструкции '
                            'по приготовлению. Просто спросите "Что приготовить из кабачков без сыра" или '
                            '"Как приготовить карбонару?". '
                            'Чтобы получить подсказку скажите "Помощь" в любой момент диалога.')
 
-    def get_help_step(self):
+    async def get_help_step(self):
         self.resp.set_text('Чтобы перейти к следующему шагу скажите "Дальше", '
                            'чтобы вернуться к предыдущему скажите "Назад". '
                            'Так же можете спросить "Как долго готовить?", '
                            '"Сколько калорий, белков, жиров или углеводов?". '
                            'Чтобы поискать другой рецепт скажите "Стоп".')
 
-    def get_help_rec_list(self):
+    async def get_help_rec_list(self):
         self.resp.set_text('Для выбора рецепта назовите его номер или название. '
                            'Чтобы перейти к следующим рецептам скажите "Дальше", '
                            'чтобы вернуться к предыдущим рецептам скажите "Назад". '
                            'Чтобы поискать другой рецепт скажите "Стоп".')
 
-    def get_help_rec_sel(self):
+    async def get_help_rec_sel(self):
         self.resp.set_text('Чтобы начать готовить скажите "Дальше".'
                            'Чтобы поискать другой рецепт скажите "Стоп".')
 
-    def repeat(self):
+    async def repeat(self):
         if len(self.history):
             self.resp.set_text(self.history[-1])
         else:
-            self.unknown()
+            await self.unknown()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Загрузка рецептов в MongoDB из JSONL (один рецепт в строке). Рецепты
+проверяются и записываются пачками неупорядоченных bulk_write с upsert
+по названию. Перед загрузкой создаются индексы, нужные навыку, после -
+серверы оповещаются об изменении рецептов.
+
+Usage:
+  ingest.py <recipes> [--mongo=<uri>] [--db=<name>] [--batch=<n>]
+  ingest.py --indexes-only [--mongo=<uri>] [--db=<name>]
+  ingest.py -h | --help
+
+Options:
+  -h --help        Показать эту справку.
+  --mongo=<uri>    Адрес MongoDB [default: mongodb://localhost:27017].
+  --db=<name>      База MongoDB [default: benedict].
+  --batch=<n>      Рецептов в одном bulk_write [default: 1000].
+  --indexes-only   Только создать и проверить индексы.
+"""
+import json
+import time
+
+from docopt import docopt
+from pymongo import ASCENDING, TEXT, ReplaceOne
+
+from logger import get_logger
+from mongo import resolve, run_sync
+from morphology import inflect_phrase, morphology
+from recipes import bump_recipes_version
+from sessions import EXPIRE_AFTER
+
+log = get_logger(app_name='ingest')
+
+# Пищевая ценность, которую называет хендлер nutrients
+NUTRIENTS = ('Калорийность', 'Белки', 'Жиры', 'Углеводы')
+# Поля полнотекстового поиска рецептов ($text в DialogHandler.search_recipes)
+TEXT_FIELDS = ('title', 'ingredients.name')
+# Если изменённых рецептов больше, серверы сбрасывают кэши целиком, а не
+# по списку названий
+MAX_CHANGED_TITLES = 1000
+# Падежи названия, которые хранятся в рецепте (title_forms), чтобы
+# хендлеры не склоняли его на каждом запросе
+TITLE_CASES = ('gent',)
+
+
+def validate_recipe(recipe):
+    """
+    Проверяет, что у рецепта есть все поля, которые читают хендлеры
+    диалога. Возвращает список ошибок, пустой для корректного рецепта.
+    """
+    if not isinstance(recipe, dict):
+        return ['recipe is not an object']
+    errors = []
+    if not isinstance(recipe.get('title'), str) or not recipe['title'].strip():
+        errors.append('title must be a non-empty string')
+    # Хендлеры подставляют порции и время в ответ как есть, числа
+    # тоже годятся
+    for field in ('portions', 'time'):
+        value = recipe.get(field)
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            errors.append('{} must be a string or a number'.format(field))
+
+    ingredients = recipe.get('ingredients')
+    if not isinstance(ingredients, list) or not ingredients:
+        errors.append('ingredients must be a non-empty list')
+    elif not all(isinstance(i, dict) and isinstance(i.get('name'), str) and 'amount' in i for i in ingredients):
+        errors.append('every ingredient needs a name and an amount')
+
+    steps = recipe.get('steps')
+    if not isinstance(steps, list) or not steps or not all(isinstance(s, str) for s in steps):
+        errors.append('steps must be a non-empty list of strings')
+
+    nutrients = recipe.get('nutrients')
+    if not isinstance(nutrients, list) or \
+            not all(isinstance(n, dict) and {'name', 'amount', 'unit'} <= n.keys() for n in nutrients):
+        errors.append('nutrients must be a list of {name, amount, unit}')
+    else:
+        missing = set(NUTRIENTS) - {n['name'] for n in nutrients}
+        if missing:
+            errors.append('nutrients miss {}'.format(', '.join(sorted(missing))))
+    return errors
+
+
+async def _ensure_index(collection, keys, **options):
+    """
+    Создаёт индекс, если его нет. Индекс с теми же полями, но другими
+    параметрами (или другой текстовый индекс - он в коллекции может быть
+    только один) удаляется и создаётся заново.
+    """
+    text = any(kind == TEXT for _, kind in keys)
+    for name, info in (await resolve(collection.index_information())).items():
+        key = [tuple(k) for k in info.get('key', [])]
+        if text:
+            if not any(kind == TEXT for _, kind in key):
+                continue
+            same = set(info.get('weights', {})) == {field for field, _ in keys} and \
+                info.get('default_language', 'english') == options.get('default_language', 'english')
+        else:
+            if key != list(keys):
+                continue
+            same = bool(info.get('unique')) == bool(options.get('unique')) and \
+                info.get('expireAfterSeconds') == options.get('expireAfterSeconds')
+        if same:
+            return name
+        log.warning('Rebuilding index {}.{}'.format(collection.name, name))
+        await resolve(collection.drop_index(name))
+    log.info('Creating index {}.{}'.format(collection.name, keys))
+    return await resolve(collection.create_index(keys, **options))
+
+
+async def ensure_indexes(db):
+    """
+    Создаёт или проверяет индексы, без которых запросы навыка читают
+    коллекцию целиком: полнотекстовый по названию и ингредиентам, по
+    названию рецепта, по идентификатору сессии и по пользователю в
+    истории.
+    """
+    await _ensure_index(db.recipes, [(field, TEXT) for field in TEXT_FIELDS], default_language='russian')
+    await _ensure_index(db.recipes, [('title', ASCENDING)], unique=True)
+    await _ensure_index(db.sessions, [('session', ASCENDING)], unique=True)
+    await _ensure_index(db.sessions, [('updated', ASCENDING)], expireAfterSeconds=EXPIRE_AFTER)
+    await _ensure_index(db.history, [('user', ASCENDING)], unique=True)
+
+
+def title_forms(title):
+    """
+    Формы названия рецепта в падежах TITLE_CASES.
+    """
+    return {case: inflect_phrase(morphology, title, case) for case in TITLE_CASES}
+
+
+def read_recipes(path):
+    """
+    Читает рецепты из JSONL по одному, пропуская некорректные строки.
+    """
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                recipe = json.loads(line)
+            except ValueError as e:
+                log.warning('Line {}: invalid JSON: {}'.format(line_no, e))
+                yield None
+                continue
+            errors = validate_recipe(recipe)
+            if errors:
+                log.warning('Line {}: {}'.format(line_no, '; '.join(errors)))
+                yield None
+                continue
+            yield recipe
+
+
+async def ingest(db, recipes, batch_size=1000):
+    """
+    Записывает рецепты пачками по batch_size неупорядоченными bulk_write,
+    рецепт с тем же названием заменяется. К рецепту добавляются формы
+    названия title_forms. Возвращает число записанных,
+    пропущенных рецептов и список названий.
+    """
+    titles = []
+    skipped = 0
+    batch = []
+    for recipe in recipes:
+        if recipe is None:
+            skipped += 1
+            continue
+        recipe.pop('_id', None)
+        recipe['title_forms'] = title_forms(recipe['title'])
+        batch.append(ReplaceOne({'title': recipe['title']}, recipe, upsert=True))
+        titles.append(recipe['title'])
+        if len(batch) >= batch_size:
+            await resolve(db.recipes.bulk_write(batch, ordered=False))
+            batch = []
+    if batch:
+        await resolve(db.recipes.bulk_write(batch, ordered=False))
+    return len(titles), skipped, titles
+
+
+async def load(db, path, batch_size):
+    # Индекс по названию нужен до загрузки: по нему ищется заменяемый рецепт
+    await ensure_indexes(db)
+    count, skipped, titles = await ingest(db, read_recipes(path), batch_size)
+    if count:
+        await bump_recipes_version(db, titles if len(titles) <= MAX_CHANGED_TITLES else None)
+    return count, skipped
+
+
+def main():
+    from pymongo import MongoClient
+
+    args = docopt(__doc__)
+    client = MongoClient(args['--mongo'])
+    db = client[args['--db']]
+    start = time.perf_counter()
+    try:
+        if args['--indexes-only']:
+            run_sync(ensure_indexes(db))
+            print('Indexes are in place')
+            return
+        count, skipped = run_sync(load(db, args['<recipes>'], int(args['--batch'])))
+    finally:
+        client.close()
+    print('{} recipes loaded, {} skipped, {:.1f}s'.format(count, skipped, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
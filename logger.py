@@ -1,29 +1,131 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# Настройки, общие для всех логгеров, меняются через configure()
+_settings = {
+    'level': logging.DEBUG,
+    'debug_sample_rate': 1.0,
+    'json_format': False,
+}
+# app_name -> (QueueHandler, QueueListener)
+_pipelines = dict()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rate записей уровня DEBUG, записи остальных
+    уровней проходят всегда.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Пишет каждую запись одной строкой JSON.
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _make_formatter():
+    if _settings['json_format']:
+        return JsonFormatter()
+    return logging.Formatter("%(asctime)s - %(message)s")
 
 
 def get_logger(app_name=__file__, path="./"):
     """
     Конфигурируем логирование и возвращаем объект, через
     который можно будет писать логи с этими настройками.
+    Запись в файл и в консоль идёт в фоновом потоке через очередь, так
+    что поток обработки запроса не ждёт диска. Повторный вызов с тем же
+    app_name не добавляет обработчиков.
     """
-    lvl = logging.DEBUG
-    filename = "{}{}.log".format(path, app_name)
-    format_str = "%(asctime)s - %(message)s"
-    formatter = logging.Formatter(format_str)
-
     logger = logging.getLogger(app_name)
-    logger.setLevel(lvl)
+    if app_name in _pipelines:
+        return logger
 
-    fh = logging.FileHandler(filename)
+    formatter = _make_formatter()
+    fh = logging.FileHandler("{}{}.log".format(path, app_name))
     ch = logging.StreamHandler()
+    fh.setFormatter(formatter)
+    ch.setFormatter(formatter)
 
-    fh.setLevel(lvl)
-    ch.setLevel(lvl)
+    qh = logging.handlers.QueueHandler(queue.Queue())
+    qh.addFilter(SamplingFilter(_settings['debug_sample_rate']))
+    listener = logging.handlers.QueueListener(qh.queue, fh, ch)
+    listener.start()
 
-    ch.setFormatter(formatter)
-    fh.setFormatter(formatter)
+    logger.setLevel(_settings['level'])
+    logger.addHandler(qh)
+    # Иначе записи дублируются обработчиком корневого логгера, который
+    # настраивает tornado
+    logger.propagate = False
+    _pipelines[app_name] = (qh, listener)
+    return logger
+
+
+def configure(level=None, debug_sample_rate=None, json_format=None):
+    """
+    Меняет уровень логирования, долю записываемых DEBUG сообщений и
+    формат (JSON или текст) для всех уже созданных и будущих логгеров.
+    """
+    if level is not None:
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+        _settings['level'] = level
+    if debug_sample_rate is not None:
+        _settings['debug_sample_rate'] = debug_sample_rate
+    if json_format is not None:
+        _settings['json_format'] = json_format
+
+    formatter = _make_formatter()
+    for app_name, (qh, listener) in _pipelines.items():
+        logging.getLogger(app_name).setLevel(_settings['level'])
+        for f in qh.filters:
+            if isinstance(f, SamplingFilter):
+                f.rate = _settings['debug_sample_rate']
+        for handler in listener.handlers:
+            handler.setFormatter(formatter)
+
+
+def _restart_listeners():
+    """
+    Поток QueueListener не переживает fork, поэтому в дочернем процессе
+    очереди и фоновые потоки создаются заново.
+    """
+    for app_name, (qh, listener) in list(_pipelines.items()):
+        qh.queue = queue.Queue()
+        new_listener = logging.handlers.QueueListener(qh.queue, *listener.handlers)
+        new_listener.start()
+        _pipelines[app_name] = (qh, new_listener)
+
+
+def _stop_listeners():
+    for qh, listener in _pipelines.values():
+        listener.stop()
 
-    logger.addHandler(ch)
-    logger.addHandler(fh)
 
-    return logger
\ No newline at end of file
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listeners)
+atexit.register(_stop_listeners)
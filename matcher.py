@@ -0,0 +1,68 @@
+class IntentMatcher:
+    """
+    Предкомпилированная таблица команд для DialogHandler.process_tokens.
+    Таблица вида {команда: {'necessary': [...], 'one_of': [...]}} один раз
+    разворачивается в индекс "токен -> фразы и команды, в которых он
+    встречается", поэтому поиск команды стоит пропорционально числу токенов
+    запроса, а не размеру таблицы.
+    Семантика совпадает с линейным проходом по таблице: команды проверяются
+    в порядке таблицы, из обязательных токенов достаточно любого, из
+    дополнительных - хотя бы одной фразы, все слова которой есть в запросе.
+    """
+
+    def __init__(self, token_list):
+        self.intents = list(token_list)
+        # Для каждой команды: нужны ли обязательные токены и доп. фразы
+        self.has_necessary = []
+        self.has_one_of = []
+        # Индексы фраз дополнительных токенов, их длины и владельцы
+        self.phrase_sizes = []
+        self.phrase_intent = []
+        self.necessary_index = dict()
+        self.phrase_index = dict()
+        for priority, target_tokens in enumerate(token_list.values()):
+            necessary = target_tokens.get('necessary', [])
+            one_of = target_tokens.get('one_of', [])
+            self.has_necessary.append(bool(len(necessary)))
+            self.has_one_of.append(bool(len(one_of)))
+            for n_token in necessary:
+                self.necessary_index.setdefault(n_token, set()).add(priority)
+            for o_token in one_of:
+                phrase = set(o_token) if type(o_token) is list else {o_token}
+                phrase_id = len(self.phrase_sizes)
+                self.phrase_sizes.append(len(phrase))
+                self.phrase_intent.append(priority)
+                for word in phrase:
+                    self.phrase_index.setdefault(word, []).append(phrase_id)
+        # Команды без условий подходят к любому запросу
+        self.always = {i for i in range(len(self.intents))
+                       if not self.has_necessary[i] and not self.has_one_of[i]}
+
+    @property
+    def vocabulary(self):
+        """
+        Все слова, встречающиеся в таблице команд.
+        """
+        return set(self.necessary_index) | set(self.phrase_index)
+
+    def match(self, tokens):
+        """
+        Возвращает имя первой подходящей команды или None.
+        """
+        necessary_found = set()
+        phrase_hits = dict()
+        for token in set(tokens):
+            necessary_found.update(self.necessary_index.get(token, ()))
+            for phrase_id in self.phrase_index.get(token, ()):
+                phrase_hits[phrase_id] = phrase_hits.get(phrase_id, 0) + 1
+
+        one_of_found = {self.phrase_intent[phrase_id] for phrase_id, hits in phrase_hits.items()
+                        if hits == self.phrase_sizes[phrase_id]}
+        candidates = necessary_found | one_of_found | self.always
+        for priority in sorted(candidates):
+            if self.has_necessary[priority] and priority not in necessary_found:
+                continue
+            if self.has_one_of[priority] and priority not in one_of_found:
+                continue
+            return self.intents[priority]
+        return None
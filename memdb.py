@@ -0,0 +1,358 @@
+"""
+База данных в памяти с подмножеством API motor, которого достаточно
+навыку. Используется нагрузочными тестами и пакетными прогонами без
+настоящего mongod. Запросы выполняются синхронно, но методы возвращают
+корутины, как асинхронный драйвер. Корутины никогда не уходят в
+ожидание, поэтому база работает и через синхронную обёртку
+mongo.run_sync.
+"""
+import copy
+import itertools
+from collections import Counter
+from types import SimpleNamespace
+
+from pymongo import InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+
+_ids = itertools.count(1)
+
+
+def _stem(word):
+    return word[:max(3, len(word) - 2)]
+
+
+def _words(text):
+    return [_stem(w) for w in text.lower().replace(',', ' ').split()]
+
+
+def _get_path(doc, path):
+    values = [doc]
+    for part in path.split('.'):
+        nxt = []
+        for value in values:
+            if isinstance(value, list):
+                nxt.extend(v.get(part) for v in value if isinstance(v, dict))
+            elif isinstance(value, dict):
+                nxt.append(value.get(part))
+        values = nxt
+    return values
+
+
+def _compare(value, cond):
+    if isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+        for op, arg in cond.items():
+            if op == '$in' and value not in arg:
+                return False
+            if op == '$nin' and value in arg:
+                return False
+            if op == '$ne' and value == arg:
+                return False
+            if op == '$exists' and (value is not None) != bool(arg):
+                return False
+            if op in ('$gt', '$gte', '$lt', '$lte'):
+                if value is None:
+                    return False
+                if op == '$gt' and not value > arg or op == '$gte' and not value >= arg:
+                    return False
+                if op == '$lt' and not value < arg or op == '$lte' and not value <= arg:
+                    return False
+        return True
+    return value == cond
+
+
+class MemoryCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.docs = []
+        self.text_fields = ['title', 'ingredients.name']
+        self.indexes = dict()
+
+    def _op(self, op):
+        self.db.operations[(self.name, op)] += 1
+
+    def _text_score(self, doc, search):
+        terms = search.split()
+        include = [_stem(t) for t in terms if not t.startswith('-')]
+        exclude = [_stem(t[1:]) for t in terms if t.startswith('-') and len(t) > 1]
+        words = []
+        for field in self.text_fields:
+            for value in _get_path(doc, field):
+                if isinstance(value, str):
+                    words.extend(_words(value))
+
+        def found(term):
+            return sum(1 for w in words if w.startswith(term) or term.startswith(w))
+        if any(found(term) for term in exclude):
+            return 0
+        return sum(found(term) for term in include)
+
+    def _match(self, doc, flt):
+        for key, cond in (flt or {}).items():
+            if key == '$text':
+                if not self._text_score(doc, cond['$search']):
+                    return False
+            elif key == '$or':
+                if not any(self._match(doc, f) for f in cond):
+                    return False
+            elif key == '$and':
+                if not all(self._match(doc, f) for f in cond):
+                    return False
+            else:
+                values = _get_path(doc, key) or [None]
+                if not any(_compare(v, cond) for v in values):
+                    return False
+        return True
+
+    def _project(self, doc, projection, flt=None):
+        if not projection:
+            return copy.deepcopy(doc)
+        if isinstance(projection, (list, tuple)):
+            projection = {field: True for field in projection}
+        result = {'_id': doc.get('_id')}
+        for field, spec in projection.items():
+            if isinstance(spec, dict) and '$meta' in spec:
+                result[field] = self._text_score(doc, flt['$text']['$search'])
+            elif isinstance(spec, dict) and '$slice' in spec:
+                value = doc.get(field) or []
+                n = spec['$slice']
+                result[field] = copy.deepcopy(value[n:] if n < 0 else value[:n])
+            elif spec and '.' in field:
+                top, rest = field.split('.', 1)
+                if isinstance(doc.get(top), list):
+                    result[top] = [{rest: item.get(rest)} for item in doc[top] if isinstance(item, dict)]
+            elif spec and field in doc:
+                result[field] = copy.deepcopy(doc[field])
+        return result
+
+    def _apply(self, doc, update, inserting=False):
+        for op, fields in update.items():
+            if op == '$set' or op == '$setOnInsert' and inserting:
+                for key, value in fields.items():
+                    doc[key] = copy.deepcopy(value)
+            elif op == '$unset':
+                for key in fields:
+                    doc.pop(key, None)
+            elif op == '$inc':
+                for key, value in fields.items():
+                    doc[key] = doc.get(key, 0) + value
+            elif op == '$push':
+                for key, value in fields.items():
+                    items = doc.setdefault(key, [])
+                    if isinstance(value, dict) and '$each' in value:
+                        items.extend(copy.deepcopy(value['$each']))
+                        if '$slice' in value:
+                            n = value['$slice']
+                            doc[key] = items[n:] if n < 0 else items[:n]
+                    else:
+                        items.append(copy.deepcopy(value))
+
+    def _upsert(self, flt, update):
+        doc = {k: v for k, v in flt.items() if not k.startswith('$') and not isinstance(v, dict)}
+        doc.setdefault('_id', next(_ids))
+        self._apply(doc, update, inserting=True)
+        self.docs.append(doc)
+        return doc
+
+    def _find(self, flt):
+        return [doc for doc in self.docs if self._match(doc, flt)]
+
+    async def find_one(self, flt=None, projection=None, **kwargs):
+        self._op('find_one')
+        for doc in self.docs:
+            if self._match(doc, flt):
+                return self._project(doc, projection, flt)
+        return None
+
+    def find(self, flt=None, projection=None, **kwargs):
+        self._op('find')
+        return MemoryCursor(self, flt, projection)
+
+    async def insert_one(self, doc):
+        self._op('insert_one')
+        doc = copy.deepcopy(doc)
+        doc.setdefault('_id', next(_ids))
+        self.docs.append(doc)
+        return SimpleNamespace(inserted_id=doc['_id'])
+
+    async def insert_many(self, docs, ordered=True):
+        self._op('insert_many')
+        ids = []
+        for doc in docs:
+            doc = copy.deepcopy(doc)
+            doc.setdefault('_id', next(_ids))
+            self.docs.append(doc)
+            ids.append(doc['_id'])
+        return SimpleNamespace(inserted_ids=ids)
+
+    def _update_one(self, flt, update, upsert=False):
+        for doc in self.docs:
+            if self._match(doc, flt):
+                self._apply(doc, update)
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = self._upsert(flt, update)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=doc['_id'])
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_one(self, flt, update, upsert=False, **kwargs):
+        self._op('update_one')
+        return self._update_one(flt, update, upsert)
+
+    async def update_many(self, flt, update, upsert=False, **kwargs):
+        self._op('update_many')
+        matched = self._find(flt)
+        for doc in matched:
+            self._apply(doc, update)
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched), upserted_id=None)
+
+    def _replace_one(self, flt, replacement, upsert=False):
+        for i, doc in enumerate(self.docs):
+            if self._match(doc, flt):
+                new = copy.deepcopy(replacement)
+                new['_id'] = doc['_id']
+                self.docs[i] = new
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            new = copy.deepcopy(replacement)
+            new.setdefault('_id', next(_ids))
+            self.docs.append(new)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=new['_id'])
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def replace_one(self, flt, replacement, upsert=False, **kwargs):
+        self._op('replace_one')
+        return self._replace_one(flt, replacement, upsert)
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        self._op('bulk_write')
+        result = SimpleNamespace(inserted_count=0, matched_count=0, modified_count=0, upserted_count=0)
+        for request in requests:
+            if isinstance(request, InsertOne):
+                doc = copy.deepcopy(request._doc)
+                doc.setdefault('_id', next(_ids))
+                self.docs.append(doc)
+                result.inserted_count += 1
+                continue
+            if isinstance(request, ReplaceOne):
+                r = self._replace_one(request._filter, request._doc, request._upsert)
+            elif isinstance(request, UpdateOne):
+                r = self._update_one(request._filter, request._doc, request._upsert)
+            else:
+                raise NotImplementedError(type(request).__name__)
+            result.matched_count += r.matched_count
+            result.modified_count += r.modified_count
+            result.upserted_count += r.upserted_id is not None
+        return result
+
+    async def find_one_and_update(self, flt, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, **kwargs):
+        self._op('find_one_and_update')
+        for doc in self.docs:
+            if self._match(doc, flt):
+                before = self._project(doc, projection)
+                self._apply(doc, update)
+                return self._project(doc, projection) if return_document == ReturnDocument.AFTER else before
+        if upsert:
+            doc = self._upsert(flt, update)
+            return self._project(doc, projection) if return_document == ReturnDocument.AFTER else None
+        return None
+
+    async def delete_one(self, flt, **kwargs):
+        self._op('delete_one')
+        for i, doc in enumerate(self.docs):
+            if self._match(doc, flt):
+                del self.docs[i]
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    async def delete_many(self, flt, **kwargs):
+        self._op('delete_many')
+        before = len(self.docs)
+        self.docs = [doc for doc in self.docs if not self._match(doc, flt)]
+        return SimpleNamespace(deleted_count=before - len(self.docs))
+
+    async def count_documents(self, flt, limit=0, **kwargs):
+        self._op('count_documents')
+        count = len(self._find(flt))
+        return min(count, limit) if limit else count
+
+    async def create_index(self, keys, **kwargs):
+        self._op('create_index')
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        text_fields = [field for field, kind in keys if kind == 'text']
+        if text_fields:
+            self.text_fields = text_fields
+        name = kwargs.get('name') or '_'.join('{}_{}'.format(field, kind) for field, kind in keys)
+        info = dict(kwargs, key=list(keys))
+        if text_fields:
+            info['weights'] = {field: 1 for field in text_fields}
+        self.indexes[name] = info
+        return name
+
+    async def drop_index(self, name, **kwargs):
+        self._op('drop_index')
+        self.indexes.pop(name, None)
+
+    async def index_information(self):
+        return copy.deepcopy(self.indexes)
+
+
+class MemoryCursor:
+    def __init__(self, collection, flt, projection):
+        self.collection = collection
+        self.flt = flt
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=None):
+        self._sort = key if isinstance(key, list) else [(key, direction or 1)]
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def max_time_ms(self, ms):
+        return self
+
+    def _results(self):
+        docs = self.collection._find(self.flt)
+        for field, direction in reversed(self._sort or []):
+            if isinstance(direction, dict):
+                # {'$meta': 'textScore'} - по убыванию релевантности
+                docs.sort(key=lambda d: self.collection._text_score(d, self.flt['$text']['$search']),
+                          reverse=True)
+            else:
+                docs.sort(key=lambda d: (d.get(field) is None, d.get(field)), reverse=direction < 0)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [self.collection._project(doc, self.projection, self.flt) for doc in docs]
+
+    async def to_list(self, length):
+        docs = self._results()
+        return docs if length is None else docs[:length]
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = dict()
+        # (коллекция, операция) -> число вызовов
+        self.operations = Counter()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
@@ -0,0 +1,216 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from mongo import resolve
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labelnames, key, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+class Histogram:
+    """
+    Гистограмма в духе Prometheus: число наблюдений по корзинам, сумма и
+    количество для каждого набора значений меток.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = dict()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                yield '{}_bucket{} {}'.format(self.name,
+                                              _format_labels(self.labelnames, key, 'le="{}"'.format(bound)),
+                                              cumulative)
+            yield '{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, key), total)
+            yield '{}_count{} {}'.format(self.name, _format_labels(self.labelnames, key), count)
+
+
+class Counter:
+    """
+    Монотонный счётчик с метками.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        for key, value in sorted(self._values.items()):
+            yield '{}{} {}'.format(self.name, _format_labels(self.labelnames, key), value)
+
+
+class StatsGauges:
+    """
+    Выставляет числовые поля словаря stats() (например, статистику
+    кэша) как gauge-метрики name_<поле>.
+    """
+
+    def __init__(self, name, documentation, stats):
+        self.name = name
+        self.documentation = documentation
+        self.stats = stats
+
+    def render(self):
+        for field, value in sorted(self.stats().items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            yield '# HELP {}_{} {}: {}'.format(self.name, field, self.documentation, field)
+            yield '# TYPE {}_{} gauge'.format(self.name, field)
+            yield '{}_{} {}'.format(self.name, field, value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Timings:
+    """
+    Длительности этапов обработки одного запроса. Собираются по ходу
+    запроса и в конце записываются в гистограмму с метками шага диалога и
+    выбранного хендлера.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    def add(self, phase, seconds):
+        self.phases.append((phase, seconds))
+
+    @contextmanager
+    def measure(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def observe(self, histogram, **labels):
+        for phase, seconds in self.phases:
+            histogram.observe(seconds, phase=phase, **labels)
+
+
+class TimedCursor:
+    """
+    Курсор, время вычитывания которого записывается в Timings.
+    """
+
+    def __init__(self, cursor, timings, phase):
+        self._cursor = cursor
+        self._timings = timings
+        self._phase = phase
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name == 'to_list':
+            async def to_list(length):
+                with self._timings.measure(self._phase):
+                    return await attr(length)
+            return to_list
+        if name in ('sort', 'skip', 'limit', 'max_time_ms', 'hint', 'batch_size'):
+            def chain(*args, **kwargs):
+                self._cursor = attr(*args, **kwargs)
+                return self
+            return chain
+        return attr
+
+    def __iter__(self):
+        with self._timings.measure(self._phase):
+            return iter(list(self._cursor))
+
+
+class TimedCollection:
+    """
+    Обёртка коллекции, которая записывает время каждого запроса к MongoDB
+    как этап mongo.<коллекция>.<операция>. Работает и с pymongo, и с motor.
+    """
+
+    def __init__(self, collection, timings):
+        self._collection = collection
+        self._timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+        phase = 'mongo.{}.{}'.format(self._collection.name, name)
+        if name == 'find':
+            return lambda *args, **kwargs: TimedCursor(attr(*args, **kwargs), self._timings, phase)
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            if not hasattr(result, '__await__'):
+                self._timings.add(phase, time.perf_counter() - start)
+                return result
+            return self._wait(result, phase, start)
+        return call
+
+    async def _wait(self, result, phase, start):
+        try:
+            return await resolve(result)
+        finally:
+            self._timings.add(phase, time.perf_counter() - start)
+
+
+class TimedDatabase:
+    def __init__(self, db, timings):
+        self._db = db
+        self._timings = timings
+
+    def __getattr__(self, name):
+        return TimedCollection(getattr(self._db, name), self._timings)
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+
+registry = Registry()
+phase_seconds = registry.register(Histogram(
+    'benedict_phase_seconds', 'Duration of request processing phases.', ('phase', 'step', 'handler')))
+degradations = registry.register(Counter(
+    'benedict_degradations_total', 'Requests answered with a fallback because the deadline ran out.', ('path',)))
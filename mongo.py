@@ -0,0 +1,199 @@
+import asyncio
+import inspect
+import time
+
+from pymongo.errors import ExecutionTimeout
+
+from logger import get_logger
+
+log = get_logger(app_name='mongo')
+
+
+async def resolve(result):
+    """
+    Дожидается результата вызова драйвера MongoDB.
+    Асинхронный драйвер (motor) возвращает future, синхронный (pymongo) -
+    готовое значение, которое отдаётся как есть.
+    """
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+async def fetch_all(cursor, length):
+    """
+    Вычитывает курсор в список не более чем из length документов,
+    length=None - без ограничения.
+    """
+    if hasattr(cursor, 'to_list'):
+        return await cursor.to_list(length)
+    return list(cursor)
+
+
+def fire_and_forget(result):
+    """
+    Не дожидается завершения асинхронной операции, только логирует её
+    ошибку. Синхронный драйвер к этому моменту уже выполнил запрос.
+    """
+    if inspect.isawaitable(result):
+        future = asyncio.ensure_future(result)
+        future.add_done_callback(_log_failure)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error('Background MongoDB operation failed: {}'.format(future.exception()))
+
+
+def run_sync(coro):
+    """
+    Выполняет корутину без event loop'а.
+    Подходит только для синхронного драйвера, когда корутина ни разу
+    не уходит в ожидание ввода-вывода.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError('Coroutine is waiting for I/O, use the async API with an async driver')
+
+
+class DeadlineExceeded(Exception):
+    """
+    Время на обработку запроса истекло.
+    """
+
+
+class Deadline:
+    """
+    Бюджет времени на обработку одного запроса. Чтениям, у которых есть
+    запасной вариант (устаревший кэш), достаётся только доля read_share
+    бюджета, чтобы после них осталось время сохранить сессию.
+    """
+
+    def __init__(self, seconds, read_share=0.7):
+        now = time.monotonic()
+        self.expires = now + seconds
+        self.read_expires = now + seconds * read_share
+
+    def remaining(self, read=False):
+        return (self.read_expires if read else self.expires) - time.monotonic()
+
+    def check(self, read=False):
+        """
+        Возвращает оставшееся время в секундах или бросает
+        DeadlineExceeded, если его не осталось.
+        """
+        remaining = self.remaining(read)
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return remaining
+
+    def check_ms(self, read=False):
+        # maxTimeMS=0 означает "без ограничения"
+        return max(1, int(self.check(read) * 1000))
+
+
+# Чтения, которые получают только часть бюджета (Deadline.read_share)
+READ_OPS = ('find', 'find_one', 'count_documents')
+# Операции, время выполнения которых ограничивается на сервере MongoDB,
+# и имя соответствующего аргумента драйвера
+MAX_TIME_ARGS = {
+    'find_one': 'max_time_ms',
+    'find_one_and_update': 'maxTimeMS',
+    'find_one_and_replace': 'maxTimeMS',
+    'find_one_and_delete': 'maxTimeMS',
+    'count_documents': 'maxTimeMS',
+}
+
+
+async def _wait(result, deadline, read=False):
+    """
+    Дожидается результата асинхронного драйвера не дольше, чем позволяет
+    deadline.
+    """
+    try:
+        return await asyncio.wait_for(resolve(result), deadline.check(read))
+    except (asyncio.TimeoutError, ExecutionTimeout):
+        raise DeadlineExceeded()
+
+
+class DeadlineCursor:
+    """
+    Курсор, вычитывание которого ограничено временем запроса.
+    """
+
+    def __init__(self, cursor, deadline):
+        self._cursor = cursor
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name == 'to_list':
+            def to_list(length):
+                return _wait(attr(length), self._deadline, read=True)
+            return to_list
+        if name in ('sort', 'skip', 'limit', 'hint', 'batch_size'):
+            def chain(*args, **kwargs):
+                self._cursor = attr(*args, **kwargs)
+                return self
+            return chain
+        return attr
+
+    def __iter__(self):
+        self._deadline.check(read=True)
+        try:
+            return iter(list(self._cursor))
+        except ExecutionTimeout:
+            raise DeadlineExceeded()
+
+
+class DeadlineCollection:
+    """
+    Обёртка коллекции, которая ограничивает каждый запрос оставшимся
+    временем запроса: на сервере через maxTimeMS, где драйвер это
+    позволяет, и на клиенте ожиданием ответа асинхронного драйвера.
+    Если время вышло, бросается DeadlineExceeded.
+    """
+
+    def __init__(self, collection, deadline):
+        self._collection = collection
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+        if name == 'find':
+            def find(*args, **kwargs):
+                cursor = attr(*args, **kwargs).max_time_ms(self._deadline.check_ms(read=True))
+                return DeadlineCursor(cursor, self._deadline)
+            return find
+
+        read = name in READ_OPS
+
+        def call(*args, **kwargs):
+            max_time_ms = self._deadline.check_ms(read)
+            if name in MAX_TIME_ARGS:
+                kwargs.setdefault(MAX_TIME_ARGS[name], max_time_ms)
+            try:
+                result = attr(*args, **kwargs)
+            except ExecutionTimeout:
+                raise DeadlineExceeded()
+            if not inspect.isawaitable(result):
+                return result
+            return _wait(result, self._deadline, read)
+        return call
+
+
+class DeadlineDatabase:
+    def __init__(self, db, deadline):
+        self._db = db
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        return DeadlineCollection(getattr(self._db, name), self._deadline)
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
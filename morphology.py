@@ -0,0 +1,139 @@
+import resource
+import time
+
+from pymorphy2 import MorphAnalyzer
+
+from cache import LRUCache
+from logger import get_logger
+
+log = get_logger(app_name='morphology')
+
+
+class Morphology:
+    """
+    Единственный на процесс морфологический анализатор.
+    Словари pymorphy2 загружаются либо явно вызовом load(), либо при
+    первом разборе слова. Время загрузки и прирост памяти процесса
+    пишутся в лог и доступны в stats().
+    """
+
+    def __init__(self):
+        self._analyzer = None
+        self.load_time = None
+        self.memory_kb = None
+
+    @property
+    def loaded(self):
+        return self._analyzer is not None
+
+    def load(self):
+        if self._analyzer is None:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            self._analyzer = MorphAnalyzer()
+            self.load_time = time.perf_counter() - start
+            self.memory_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            log.info('pymorphy2 dictionaries loaded in {:.2f}s, +{} KB RSS'.format(self.load_time,
+                                                                               self.memory_kb))
+        return self._analyzer
+
+    def parse(self, word):
+        return self.load().parse(word)
+
+    def stats(self):
+        return {'loaded': self.loaded, 'load_time': self.load_time, 'memory_kb': self.memory_kb}
+
+
+class LemmaCache:
+    """
+    Кэш нормальных форм слов перед pymorphy2.
+    Словарь запросов к кулинарному навыку небольшой и часто повторяется,
+    поэтому разбор слова морфологическим анализатором выполняется один раз,
+    а дальше нормальная форма берётся из LRU-кэша.
+    """
+
+    def __init__(self, morph, maxsize=50000):
+        self.morph = morph
+        self.cache = LRUCache(maxsize)
+        self.forms_cache = LRUCache(maxsize)
+
+    def normalize(self, word):
+        # pymorphy2 всё равно приводит слово к нижнему регистру
+        word = word.lower()
+        lemma = self.cache.get(word)
+        if lemma is None:
+            lemma = self.morph.parse(word)[0].normal_form
+            self.cache.put(word, lemma)
+        return lemma
+
+    def normalize_many(self, words):
+        return [self.normalize(word) for word in words]
+
+    def warmup(self, words):
+        """
+        Заранее разбирает слова, которые точно встретятся в запросах.
+        """
+        for word in words:
+            self.normalize(word)
+            self.normal_forms(word)
+
+    def normal_forms(self, word):
+        """
+        Все различные нормальные формы слова по всем вариантам разбора.
+        Нужны там, где первый вариант разбора может ошибиться
+        ("кабачков" -> "кабачковый", а не "кабачок").
+        """
+        word = word.lower()
+        forms = self.forms_cache.get(word)
+        if forms is None:
+            forms = tuple(dict.fromkeys(p.normal_form for p in self.morph.parse(word)))
+            self.forms_cache.put(word, forms)
+        return forms
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def inflect_phrase(morph, string, case):
+    """
+    Ставит словосочетание в падеж case: слова склоняются до первого
+    существительного включительно, остальные остаются как есть
+    ("салат из кабачков" -> "салата из кабачков").
+    """
+    ans = []
+    transform = True
+    for word in string.split(' '):
+        w = morph.parse(word)[0].inflect({case})
+        if w and transform:
+            ans.append(w.word)
+            if 'NOUN' in w.tag:
+                transform = False
+        else:
+            ans.append(word)
+    return ' '.join(ans)
+
+
+class NumberAgreement:
+    """
+    Согласование слов с числительными ("1 рецепт", "3 рецепта",
+    "12 рецептов") по заранее построенным таблицам. Форма слова зависит
+    только от двух последних цифр числа, поэтому для каждого слова
+    разбор pymorphy2 выполняется 100 раз один раз на процесс.
+    """
+
+    def __init__(self, morph):
+        self.morph = morph
+        self.tables = dict()
+
+    def table(self, word):
+        forms = self.tables.get(word)
+        if forms is None:
+            parse = self.morph.parse(word)[0]
+            forms = self.tables[word] = [parse.make_agree_with_number(n).word for n in range(100)]
+        return forms
+
+    def agree(self, word, number):
+        return self.table(word)[number % 100]
+
+
+morphology = Morphology()
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+
+from pymongo import UpdateOne
+
+from logger import get_logger
+from mongo import fetch_all, resolve
+
+log = get_logger(app_name='profiler')
+
+# Настройки профилирования, общие для всех процессов
+CONTROL_ID = 'profiler'
+# Дольше профилирование не включается
+MAX_DURATION = 3600
+
+
+def stack_id(handler, stack):
+    return hashlib.blake2b('{}\n{}'.format(handler, stack).encode(), digest_size=12).hexdigest()
+
+
+class Profiler:
+    """
+    Статистический профилировщик запросов к навыку, включается на ходу.
+    Доля rate запросов отмечается для профилирования, поток-сэмплер раз в
+    interval секунд снимает стек потока event loop'а и, если в этот момент
+    выполняется отмеченный запрос, записывает стек выше его post().
+    Стеки группируются по хендлеру DialogHandler, обработавшему запрос.
+    Ожидание ответа MongoDB в стеки не попадает, его показывают метрики
+    benedict_phase_seconds.
+    Пока профилирование выключено, запрос платит одной проверкой в
+    sample(), а сэмплер спит.
+    Настройки берутся из db.meta, накопленные стеки сбрасываются в
+    db.profile (sync), так что профилирование включается и читается
+    сразу для всех процессов сервера.
+    """
+
+    def __init__(self):
+        self.rate = 0.0
+        self.interval = 0.005
+        self.until = None
+        self.started = None
+        # (хендлер, стек) -> число снимков, хендлер -> число запросов
+        self.stacks = dict()
+        self.requests = dict()
+        # Кадр post() отмеченного запроса -> снимки его стека
+        self._active = dict()
+        self._labels = dict()
+        self._thread = None
+        self._thread_id = None
+        self._wakeup = threading.Event()
+
+    def sample(self):
+        """
+        Нужно ли профилировать очередной запрос.
+        """
+        return self.rate > 0 and random.random() < self.rate
+
+    def configure(self, rate, interval=None, until=None, started=None):
+        if started != self.started:
+            # Новый сеанс профилирования - старые стеки не нужны
+            self.stacks, self.requests = dict(), dict()
+            self.started = started
+        if interval:
+            self.interval = interval
+        self.until = until
+        self.rate = min(max(rate, 0.0), 1.0)
+        if self.rate and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+
+    def begin(self, frame):
+        """
+        Отмечает запрос, frame - кадр его обработчика.
+        """
+        self._thread_id = threading.get_ident()
+        self._active[frame] = []
+
+    def end(self, frame, handler):
+        samples = self._active.pop(frame)
+        handler = handler or 'unknown'
+        self.requests[handler] = self.requests.get(handler, 0) + 1
+        for stack in samples:
+            key = (handler, stack)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def _run(self):
+        while True:
+            if not self.rate:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            if self.until is not None and time.time() >= self.until:
+                log.info('Profiling finished')
+                self.rate = 0.0
+                continue
+            if self._active:
+                self._record(sys._current_frames().get(self._thread_id))
+            time.sleep(self.interval)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                             code.co_firstlineno)
+        return label
+
+    def _record(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame.f_code))
+            samples = self._active.get(frame)
+            if samples is not None:
+                samples.append(';'.join(reversed(stack)))
+                return
+            frame = frame.f_back
+
+    async def flush(self, db):
+        """
+        Добавляет накопленные в процессе стеки к общим в db.profile.
+        """
+        stacks, requests = self.stacks, self.requests
+        if not stacks and not requests:
+            return
+        self.stacks, self.requests = dict(), dict()
+        ops = [UpdateOne({'_id': stack_id(handler, stack)},
+                         {'$inc': {'samples': n}, '$setOnInsert': {'handler': handler, 'stack': stack}},
+                         upsert=True)
+               for (handler, stack), n in stacks.items()]
+        # Число запросов хранится в записи с пустым стеком
+        ops.extend(UpdateOne({'_id': stack_id(handler, '')},
+                             {'$inc': {'requests': n}, '$setOnInsert': {'handler': handler, 'stack': ''}},
+                             upsert=True)
+                   for handler, n in requests.items())
+        await resolve(db.profile.bulk_write(ops, ordered=False))
+
+    async def sync(self, db):
+        """
+        Применяет общие настройки из db.meta и сбрасывает стеки в базу.
+        Вызывается периодически в каждом процессе сервера.
+        """
+        try:
+            control = await resolve(db.meta.find_one({'_id': CONTROL_ID})) or {}
+            until = control.get('until')
+            rate = control.get('rate', 0.0) if until is None or until > time.time() else 0.0
+            if rate or self.rate:
+                self.configure(rate, control.get('interval'), until, control.get('started'))
+            await self.flush(db)
+        except Exception as e:
+            log.warning('Profiler sync failed: %s', e)
+
+    def stats(self):
+        return {'rate': self.rate, 'active': len(self._active), 'stacks': len(self.stacks)}
+
+
+async def start_profiling(db, rate, interval=0.005, duration=300):
+    """
+    Включает профилирование во всех процессах на duration секунд и
+    сбрасывает собранные ранее стеки.
+    rate=0 выключает профилирование, собранные стеки остаются.
+    """
+    control = {'rate': rate, 'interval': interval,
+               'until': time.time() + min(duration, MAX_DURATION) if rate else None}
+    if rate:
+        control['started'] = time.time()
+        await resolve(db.profile.delete_many({}))
+    await resolve(db.meta.update_one({'_id': CONTROL_ID}, {'$set': control}, upsert=True))
+
+
+async def profile_summary(db):
+    """
+    Настройки профилирования и число запросов и снимков по хендлерам.
+    """
+    control = await resolve(db.meta.find_one({'_id': CONTROL_ID})) or {}
+    handlers = dict()
+    for doc in await fetch_all(db.profile.find({}), None):
+        counts = handlers.setdefault(doc['handler'], {'requests': 0, 'samples': 0})
+        counts['requests'] += doc.get('requests', 0)
+        counts['samples'] += doc.get('samples', 0)
+    return {'rate': control.get('rate', 0.0), 'interval': control.get('interval'),
+            'until': control.get('until'), 'handlers': handlers}
+
+
+async def collapsed_stacks(db, handler=None):
+    """
+    Стеки в свёрнутом формате flamegraph.pl и speedscope: по строке
+    "хендлер;функция;...;функция число_снимков" на стек.
+    """
+    flt = {'handler': handler} if handler else {}
+    lines = []
+    for doc in await fetch_all(db.profile.find(flt), None):
+        if doc.get('stack'):
+            lines.append('{};{} {}'.format(doc['handler'], doc['stack'], doc['samples']))
+    lines.sort()
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+profiler = Profiler()
@@ -0,0 +1,129 @@
+from cache import LRUCache
+from mongo import fetch_all, resolve
+
+
+class RecipeCache:
+    """
+    Источник рецептов из MongoDB (другой источник - snapshot.RecipeSnapshot,
+    интерфейс у них общий: get и get_stale).
+    Кэш документов рецептов внутри процесса, ключ - название рецепта.
+    Записи вытесняются по размеру и времени жизни. Если запрошены только
+    некоторые поля (fields), из базы читаются только они, а в кэше
+    накапливаются уже загруженные поля документа.
+    """
+
+    def __init__(self, maxsize=1000, ttl=600):
+        self.cache = LRUCache(maxsize, ttl)
+
+    async def get(self, collection, title, fields=None):
+        entry = self.cache.get(title)
+        if entry is not None:
+            doc, loaded = entry
+            # loaded is None - документ загружен целиком
+            if loaded is None or (fields is not None and loaded.issuperset(fields)):
+                return doc
+
+        if fields is None:
+            projection = None
+        else:
+            fields = set(fields) | {'title'}
+            if entry is not None and entry[1] is not None:
+                fields |= entry[1]
+            projection = {field: True for field in fields}
+        doc = await resolve(collection.find_one({'title': title}, projection))
+        if doc is not None:
+            self.cache.put(title, (doc, fields))
+        return doc
+
+    async def prefetch(self, collection, titles, fields):
+        """
+        Загружает в кэш одним запросом поля fields рецептов titles, если
+        их там ещё нет или записи устарели.
+        """
+        fields = set(fields) | {'title'}
+        missing = []
+        for title in titles:
+            entry = self.cache.peek(title)
+            if entry is None:
+                missing.append(title)
+            elif entry[1] is not None and not entry[1].issuperset(fields):
+                # Уже загруженные поля перечитываются, чтобы запись в кэше
+                # осталась целой
+                fields |= entry[1]
+                missing.append(title)
+        if not missing:
+            return
+        projection = {field: True for field in fields}
+        for doc in await fetch_all(collection.find({'title': {'$in': missing}}, projection), len(missing)):
+            self.cache.put(doc['title'], (doc, fields))
+
+    def get_stale(self, title, fields=None):
+        """
+        Документ из кэша без обращения к базе, даже устаревший. None, если
+        нужных полей в кэше нет.
+        """
+        entry = self.cache.get(title, stale=True)
+        if entry is None:
+            return None
+        doc, loaded = entry
+        if loaded is None or (fields is not None and loaded.issuperset(fields)):
+            return doc
+        return None
+
+    def invalidate(self, titles=None):
+        """
+        Сбрасывает закэшированные рецепты titles, а если они не заданы -
+        весь кэш.
+        """
+        if titles is None:
+            self.cache.clear()
+            return
+        for title in titles:
+            self.cache.pop(title)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+async def bump_recipes_version(db, titles=None):
+    """
+    Отмечает изменение коллекции рецептов, чтобы процессы сервера сбросили
+    свои кэши. titles - изменённые рецепты, None означает "изменилось всё".
+    """
+    await resolve(db.meta.update_one({'_id': 'recipes'},
+                                     {'$inc': {'version': 1}, '$set': {'titles': titles}},
+                                     upsert=True))
+
+
+class RecipesWatcher:
+    """
+    Периодически проверяет версию коллекции рецептов и оповещает
+    подписчиков (кэши, индексы) об изменениях. Подписчик вызывается со
+    списком изменённых названий (None - изменилось всё) и может быть
+    корутиной.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    async def poll(self, db):
+        meta = await resolve(db.meta.find_one({'_id': 'recipes'})) or {}
+        version = meta.get('version', 0)
+        if self.version is None or version == self.version:
+            self.version = version
+            return
+        # Если между проверками было несколько изменений, список
+        # изменённых рецептов неполон - сбрасываем всё
+        titles = meta.get('titles') if version == self.version + 1 else None
+        self.version = version
+        for callback in self.listeners:
+            await resolve(callback(titles))
+
+
+recipe_cache = RecipeCache()
+recipes_watcher = RecipesWatcher()
+recipes_watcher.subscribe(recipe_cache.invalidate)
@@ -0,0 +1,62 @@
+import asyncio
+
+from cache import LRUCache
+
+
+class ReplayCache:
+    """
+    Ответы на недавние запросы по ключу (session_id, message_id).
+    Алиса повторяет запрос, если ответ задерживается. Повтор получает
+    ответ из кэша или дожидается обработки такого же запроса, который ещё
+    выполняется, и не запускает ход диалога второй раз.
+    Кэш свой у каждого процесса. Повтор, попавший в другой процесс, ловит
+    DialogHandler по ответу, сохранённому в сессии.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.cache = LRUCache(maxsize, ttl)
+        self.in_flight = dict()
+        self.merged = 0
+
+    @staticmethod
+    def key(alice_request):
+        return alice_request.session.get('session_id'), alice_request.session.get('message_id')
+
+    async def run(self, key, handle):
+        """
+        Возвращает ответ на запрос key: из кэша, от обработки такого же
+        запроса, которая ещё идёт, или от handle(). handle - корутина,
+        возвращающая пару (ответ, можно ли отдавать его повторам). Ответы,
+        после которых сессия не изменилась (например, "повторите" после
+        нехватки времени), не кэшируются: повтор обрабатывается заново.
+        """
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.merged += 1
+            # shield: отмена повтора не должна отменять ожидание остальных
+            response = await asyncio.shield(future)
+            if response is not None:
+                return response
+            return (await handle())[0]
+
+        future = asyncio.get_event_loop().create_future()
+        self.in_flight[key] = future
+        response = replayable = None
+        try:
+            response, replayable = await handle()
+        finally:
+            del self.in_flight[key]
+            # Ожидающие повторы получают None и обрабатывают запрос сами
+            future.set_result(response if replayable else None)
+        if replayable:
+            self.cache.put(key, response)
+        return response
+
+    def stats(self):
+        return dict(self.cache.stats(), in_flight=len(self.in_flight), merged=self.merged)
+
+
+replay_cache = ReplayCache()
@@ -0,0 +1,156 @@
+import math
+import re
+from heapq import nsmallest
+
+from cache import LRUCache
+from mongo import resolve, fetch_all
+
+STOP_WORDS = {'и', 'с', 'со', 'в', 'во', 'на', 'из', 'без', 'по', 'а', 'или', 'для', 'к', 'под'}
+
+
+class RecipeIndex:
+    """
+    Инвертированный индекс рецептов в памяти с ранжированием BM25.
+    Индексируются нормальные формы слов названия и названий ингредиентов,
+    слова названия весят больше. У слова учитываются все варианты
+    разбора, поэтому "кабачков" в запросе находит "кабачки" в рецепте.
+    """
+    k1 = 1.2
+    b = 0.75
+    title_weight = 2
+
+    def __init__(self, lemmas):
+        self.lemmas = lemmas
+        # нормальная форма -> {название рецепта: частота}
+        self.postings = dict()
+        # название рецепта -> {нормальная форма: частота}
+        self.terms = dict()
+        self.lengths = dict()
+        self.total_length = 0
+
+    def analyze(self, text):
+        """
+        Разбивает текст на слова и возвращает для каждого кортеж его
+        нормальных форм. Стоп-слова отбрасываются.
+        """
+        words = re.findall(r'\w+', text.lower())
+        return [self.lemmas.normal_forms(word) for word in words if word not in STOP_WORDS]
+
+    def add(self, recipe):
+        title = recipe['title']
+        self.remove(title)
+        terms = dict()
+        length = 0
+        fields = [(recipe.get('title', ''), self.title_weight)]
+        fields.extend((ingr.get('name', ''), 1) for ingr in recipe.get('ingredients') or [])
+        for text, weight in fields:
+            for forms in self.analyze(text):
+                length += weight
+                for form in forms:
+                    terms[form] = terms.get(form, 0) + weight
+        self.terms[title] = terms
+        self.lengths[title] = length
+        self.total_length += length
+        for form, tf in terms.items():
+            self.postings.setdefault(form, dict())[title] = tf
+
+    def remove(self, title):
+        terms = self.terms.pop(title, None)
+        if terms is None:
+            return
+        self.total_length -= self.lengths.pop(title)
+        for form in terms:
+            posting = self.postings[form]
+            del posting[title]
+            if not posting:
+                del self.postings[form]
+
+    def _scores(self, include, exclude):
+        """
+        Оценки BM25 рецептов со словами include и без слов exclude.
+        """
+        n = len(self.terms)
+        if not n:
+            return {}
+        avgdl = self.total_length / n
+        scores = dict()
+        for forms in self.analyze(' '.join(include)):
+            # Частота слова запроса в рецепте - лучшая по вариантам разбора
+            matched = dict()
+            for form in forms:
+                for title, tf in self.postings.get(form, {}).items():
+                    matched[title] = max(tf, matched.get(title, 0))
+            if not matched:
+                continue
+            idf = math.log(1 + (n - len(matched) + 0.5) / (len(matched) + 0.5))
+            for title, tf in matched.items():
+                norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self.lengths[title] / avgdl))
+                scores[title] = scores.get(title, 0) + idf * norm
+
+        for forms in self.analyze(' '.join(exclude)):
+            for form in forms:
+                for title in self.postings.get(form, ()):
+                    scores.pop(title, None)
+        return scores
+
+    def search(self, include, exclude=(), limit=10, skip=0):
+        """
+        Ищет рецепты по словам include, исключая рецепты со словами
+        exclude. Возвращает не более limit документов вида
+        {'title': ..., 'score': ...} по убыванию релевантности, пропустив
+        первые skip.
+        """
+        # При равных оценках порядок задаёт название, чтобы страницы
+        # результатов не менялись между запросами
+        ranked = nsmallest(skip + limit, self._scores(include, exclude).items(), key=lambda x: (-x[1], x[0]))
+        return [{'title': title, 'score': score} for title, score in ranked[skip:]]
+
+    async def refresh(self, db, titles=None):
+        """
+        Перестраивает индекс по рецептам из базы: только рецепты titles,
+        а если они не заданы - весь индекс целиком.
+        """
+        projection = {'title': True, 'ingredients.name': True}
+        if titles is None:
+            index = RecipeIndex(self.lemmas)
+            for recipe in await fetch_all(db.recipes.find({}, projection), None):
+                index.add(recipe)
+            self.postings, self.terms = index.postings, index.terms
+            self.lengths, self.total_length = index.lengths, index.total_length
+            return
+        for title in titles:
+            recipe = await resolve(db.recipes.find_one({'title': title}, projection))
+            if recipe is None:
+                self.remove(title)
+            else:
+                self.add(recipe)
+
+
+class SearchCache:
+    """
+    Общий для всех пользователей кэш результатов поиска рецептов.
+    Ключ - канонический запрос: множества нормальных форм включаемых и
+    исключаемых слов, поэтому "из курицы и риса" и "из риса и курицы"
+    попадают в одну запись. Любое изменение рецептов сбрасывает кэш.
+    """
+
+    def __init__(self, lemmas, maxsize=5000, ttl=300):
+        self.lemmas = lemmas
+        self.cache = LRUCache(maxsize, ttl)
+
+    def key(self, backend, include, exclude, limit, skip=0):
+        include = frozenset(self.lemmas.normalize_many(include)) - STOP_WORDS
+        exclude = frozenset(self.lemmas.normalize_many(exclude)) - STOP_WORDS
+        return backend, include, exclude, limit, skip
+
+    def get(self, key, stale=False):
+        return self.cache.get(key, stale=stale)
+
+    def put(self, key, recipe_list):
+        self.cache.put(key, recipe_list)
+
+    def invalidate(self, titles=None):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
@@ -1,16 +1,69 @@
 #!/usr/bin/env python3
 # coding: utf-8
+"""
+Benedict's recipes Alice API.
+
+Usage:
+  server.py [--port=<port>] [--workers=<n>] [--mongo=<uri>] [--search=<backend>] [--sessions=<mode>] [--debug]
+            [--deadline=<seconds>] [--snapshot=<file>] [--prefetch] [--admin-port=<port>]
+            [--log-level=<level>] [--log-sample=<rate>] [--log-json]
+  server.py -h | --help
+
+Options:
+  -h --help             Показать эту справку.
+  --port=<port>         Порт HTTP сервера [default: 8088].
+  --admin-port=<port>   Порт /metrics и /profile на 127.0.0.1, процесс N слушает
+                        порт admin-port + N [default: 9088].
+  --workers=<n>         Число процессов, 0 - по числу ядер [default: 1].
+  --mongo=<uri>         Адрес MongoDB [default: mongodb://127.0.0.1:27017/].
+  --search=<backend>    Поиск рецептов: mongo или local [default: mongo].
+  --sessions=<mode>     Хранение сессий: db, memory или write-behind [default: db].
+                        memory и write-behind держат сессии в памяти процесса и
+                        требуют, чтобы запросы сессии приходили в один процесс.
+  --deadline=<seconds>  Время на обработку запроса, после него - запасной ответ [default: 2.5].
+  --snapshot=<file>     Читать рецепты из снимка, собранного snapshot.py.
+  --prefetch            После ответа загружать рецепты, нужные на следующем ходу.
+  --debug               Режим отладки с автоперезагрузкой, только один процесс.
+  --log-level=<level>   Уровень логирования [default: DEBUG].
+  --log-sample=<rate>   Доля записываемых DEBUG сообщений [default: 1].
+  --log-json            Писать логи в формате JSON.
+"""
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
+import functools
+import gc
 import json
+import sys
+from docopt import docopt
+from motor.motor_tornado import MotorClient
 from pymongo import MongoClient
 
 from alice import AliceRequest, AliceResponse
-from dialog import DialogHandler
-from logger import get_logger
+from dialog import DialogHandler, recipe_index, warmup
+from logger import get_logger, configure as configure_logging
+from metrics import registry, phase_seconds, StatsGauges, Timings
+from mongo import Deadline, run_sync
+from recipes import recipe_cache, recipes_watcher
+from profiler import MAX_DURATION, collapsed_stacks, profile_summary, profiler, start_profiling
+from replay import replay_cache
+from sessions import session_store
+from snapshot import RecipeSnapshot
+
+MONGO_URI = 'mongodb://127.0.0.1:27017/'
+
+registry.register(StatsGauges('benedict_replay_cache', 'Replayed responses to retried requests', replay_cache.stats))
+registry.register(StatsGauges('benedict_profiler', 'Sampling profiler', profiler.stats))
 
-client = MongoClient('mongodb://127.0.0.1:27017/')
-db = client.benedict
+
+def make_db(uri=MONGO_URI):
+    """
+    Создаёт асинхронный клиент MongoDB. При запуске нескольких процессов
+    вызывается после fork'а: клиент нельзя разделять между процессами.
+    """
+    return MotorClient(uri).benedict
 
 
 class BenedictHandler(tornado.web.RequestHandler):
@@ -30,20 +83,168 @@ class BenedictHandler(tornado.web.RequestHandler):
         output = "Benedict's recipes Alice API"
         self.write(self.format_resp(output))
 
-    def post(self):
-        alice_request = AliceRequest(json.loads(self.request.body.decode()))
-        alice_response = AliceResponse(alice_request)
-        self.write(DialogHandler(alice_request, alice_response, db).get_response())
+    async def post(self):
+        if not profiler.sample():
+            await self.handle()
+            return
+        frame = sys._getframe()
+        profiler.begin(frame)
+        dialog = None
+        try:
+            dialog = await self.handle()
+        finally:
+            profiler.end(frame, dialog.handler_name if dialog is not None else None)
+
+    async def handle(self):
+        deadline = Deadline(self.settings['deadline'])
+        timings = Timings()
+        with timings.measure('total'):
+            with timings.measure('parse'):
+                alice_request = AliceRequest.from_json(self.request.body)
+            alice_response = AliceResponse(alice_request)
+            dialog = DialogHandler(alice_request, alice_response, self.settings['db'], timings, deadline)
+            # Повторы запроса Алисой получают тот же ответ без второго хода
+            self.write(await replay_cache.run(replay_cache.key(alice_request),
+                                              functools.partial(self.respond, dialog)))
+        if dialog.session is None:
+            # Ответ взят из replay_cache
+            dialog.step = dialog.handler_name = 'replay'
+        timings.observe(phase_seconds, step=dialog.step, handler=dialog.handler_name)
+        if dialog.prefetch_recipes:
+            # Ответ уже отправлен, Алиса его не ждёт
+            self.finish()
+            await dialog.prefetch(self.settings['db'])
+        return dialog
 
+    @staticmethod
+    async def respond(dialog):
+        response = await dialog.get_response_async()
+        return response, dialog.replayable
 
-def make_app():
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        """
+        Метрики процесса в текстовом формате Prometheus.
+        """
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(registry.render())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    async def get(self):
+        """
+        Результаты профилирования всех процессов: сводка по хендлерам в
+        JSON или, с ?format=collapsed, стеки для flamegraph.pl
+        (&handler=<хендлер> - только одного хендлера).
+        """
+        db = self.settings['db']
+        await profiler.flush(db)
+        if self.get_argument('format', 'json') == 'collapsed':
+            self.set_header("Content-Type", "text/plain; charset=utf-8")
+            self.write(await collapsed_stacks(db, self.get_argument('handler', None)))
+        else:
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(await profile_summary(db)))
+
+    async def post(self):
+        """
+        Включает профилирование: ?rate=<доля запросов>
+        [&interval=<секунд между снимками>][&duration=<секунд, не больше
+        MAX_DURATION>]. rate=0 выключает.
+        """
+        db = self.settings['db']
+        try:
+            rate = float(self.get_argument('rate'))
+            interval = float(self.get_argument('interval', '0.005'))
+            duration = float(self.get_argument('duration', '300'))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not 0 <= rate <= 1 or interval < 0.001 or not 0 < duration <= MAX_DURATION:
+            raise tornado.web.HTTPError(400)
+        await start_profiling(db, rate, interval, duration)
+        # Остальные процессы подхватят настройки при следующем sync
+        await profiler.sync(db)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(await profile_summary(db)))
+
+
+def make_app(db=None, debug=False, deadline=2.5):
+    if db is None:
+        db = make_db()
     return tornado.web.Application([
         (r"/benedict", BenedictHandler),
-    ], debug=True)
+    ], db=db, debug=debug, deadline=deadline)
 
 
-if __name__ == "__main__":
+def make_admin_app(db):
+    """
+    Служебные страницы процесса: метрики и профилирование. У каждого
+    процесса свой порт, так что метрики собираются с каждого процесса
+    отдельно, и слушается он только на 127.0.0.1.
+    """
+    return tornado.web.Application([
+        (r"/metrics", MetricsHandler),
+        (r"/profile", ProfileHandler),
+    ], db=db)
+
+
+def main():
+    args = docopt(__doc__)
+    port = int(args['--port'])
+    workers = int(args['--workers'])
+    debug = args['--debug']
+    if debug:
+        # Автоперезагрузка несовместима с несколькими процессами
+        workers = 1
+    configure_logging(level=args['--log-level'], debug_sample_rate=float(args['--log-sample']),
+                      json_format=args['--log-json'])
     log = get_logger(app_name='server')
-    app = make_app()
-    app.listen(8088)
+    DialogHandler.search_backend = args['--search']
+    DialogHandler.prefetch_recipes = args['--prefetch']
+    session_store.set_mode(args['--sessions'])
+    AliceResponse.pretty = debug
+
+    # Всё, что создано до fork'а (словари pymorphy2, кэш лемм, индекс
+    # рецептов), процессы делят по copy-on-write.
+    warmup()
+    if args['--snapshot']:
+        # Снимок отображается в память один раз, страницы файла общие для
+        # всех процессов
+        snapshot = RecipeSnapshot(args['--snapshot'], fallback=recipe_cache)
+        DialogHandler.recipes = snapshot
+        recipes_watcher.subscribe(snapshot.refresh)
+        registry.register(StatsGauges('benedict_recipe_snapshot', 'Recipe snapshot', snapshot.stats))
+    if DialogHandler.search_backend == 'local':
+        client = MongoClient(args['--mongo'])
+        run_sync(recipe_index.refresh(client.benedict))
+        client.close()
+    if hasattr(gc, 'freeze'):
+        # Сборщик мусора не трогает унаследованные объекты и не
+        # копирует их страницы памяти
+        gc.freeze()
+    sockets = tornado.netutil.bind_sockets(port)
+    if workers != 1:
+        tornado.process.fork_processes(workers)
+
+    db = make_db(args['--mongo'])
+    if DialogHandler.search_backend == 'local':
+        recipes_watcher.subscribe(functools.partial(recipe_index.refresh, db))
+    server = tornado.httpserver.HTTPServer(make_app(db, debug=debug, deadline=float(args['--deadline'])))
+    server.add_sockets(sockets)
+    task_id = tornado.process.task_id() or 0
+    admin_port = int(args['--admin-port']) + task_id
+    make_admin_app(db).listen(admin_port, address='127.0.0.1')
+    log.info('Worker {} is listening on port {}, admin port {}'.format(task_id, port, admin_port))
+    # Следим за обновлениями рецептов, чтобы сбрасывать кэши
+    tornado.ioloop.PeriodicCallback(functools.partial(recipes_watcher.poll, db), 10000).start()
+    if args['--snapshot']:
+        # Подменённый файл снимка переоткрывается без сброса кэшей
+        tornado.ioloop.PeriodicCallback(DialogHandler.recipes.reload, 10000).start()
+    # Настройки профилирования и сброс собранных стеков
+    tornado.ioloop.PeriodicCallback(functools.partial(profiler.sync, db), 5000).start()
     tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+from datetime import datetime
+
+from pymongo import ReturnDocument
+
+from cache import LRUCache
+from logger import get_logger
+from mongo import fire_and_forget, resolve
+
+log = get_logger(app_name='sessions')
+
+# Состояние новой сессии
+DEFAULTS = {'recipe': '', 'step': 'start', 'query': None, 'page': 0}
+# Через сколько секунд без изменений сессия удаляется из db.sessions
+# TTL-индексом по полю updated (см. ingest.ensure_indexes)
+EXPIRE_AFTER = 24 * 3600
+# Режимы хранилища:
+#   db           - сессия читается из базы на каждом ходу, подходит для
+#                  любой балансировки запросов между процессами;
+#   memory       - сессия читается из памяти процесса, запись в базу
+#                  сразу (write-through), нужна привязка сессии к процессу;
+#   write-behind - как memory, но запись в базу не задерживает ответ.
+MODES = ('db', 'memory', 'write-behind')
+
+
+class SessionStore:
+    """
+    Хранилище состояния сессий диалога: MongoDB и горячий слой в памяти
+    процесса (LRU с временем жизни с последнего обращения).
+    У сессии есть номер ревизии rev, запись проходит только если ревизия
+    в базе не менялась. Если сессию успел изменить другой процесс, save()
+    возвращает False, сессия выбрасывается из памяти, и ход можно
+    обработать заново со свежим состоянием.
+    """
+
+    def __init__(self, mode='db', maxsize=10000, idle_ttl=600):
+        self.cache = LRUCache(maxsize, idle_ttl)
+        self.conflicts = 0
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        if mode not in MODES:
+            raise ValueError('Unknown session store mode {}'.format(mode))
+        self.mode = mode
+        self.cache.clear()
+
+    async def load(self, collection, session_id):
+        """
+        Возвращает копию состояния сессии, создавая сессию при первом
+        обращении.
+        """
+        session = None if self.mode == 'db' else self.cache.get(session_id)
+        if session is None:
+            session = await resolve(collection.find_one_and_update(
+                {'session': session_id},
+                {'$setOnInsert': dict(DEFAULTS, rev=0, updated=datetime.utcnow())},
+                upsert=True, return_document=ReturnDocument.AFTER))
+            if self.mode != 'db':
+                self.cache.put(session_id, session)
+        return dict(session)
+
+    async def save(self, collection, session_id, session, changes):
+        """
+        Сохраняет изменения сессии changes, session - состояние сессии с
+        уже применёнными изменениями. Возвращает False, если сессию
+        изменил кто-то другой и изменения не записаны.
+        """
+        if not changes:
+            if self.mode != 'db':
+                # Продлеваем время жизни в памяти
+                self.cache.put(session_id, session)
+            return True
+        rev = session.get('rev')
+        session['rev'] = (rev or 0) + 1
+        if self.mode == 'write-behind':
+            # Запись может обогнать запись предыдущего хода, поэтому
+            # пишется всё состояние, а более старая ревизия не затирает
+            # более новую
+            state = {k: v for k, v in session.items() if k != '_id'}
+            state['updated'] = datetime.utcnow()
+            fire_and_forget(collection.update_one(
+                {'session': session_id, '$or': [{'rev': {'$lt': session['rev']}}, {'rev': None}]},
+                {'$set': state}))
+            self.cache.put(session_id, session)
+            return True
+
+        result = await resolve(collection.update_one(
+            {'session': session_id, 'rev': rev},
+            {'$set': dict(changes, updated=datetime.utcnow()), '$inc': {'rev': 1}}))
+        if not result.matched_count:
+            self.conflicts += 1
+            self.cache.pop(session_id)
+            session['rev'] = rev
+            return False
+        if self.mode != 'db':
+            self.cache.put(session_id, session)
+        return True
+
+    def stats(self):
+        return dict(self.cache.stats(), conflicts=self.conflicts)
+
+
+session_store = SessionStore()
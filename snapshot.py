@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Снимок коллекции рецептов в одном файле только для чтения. Процессы
+сервера отображают файл в память (mmap), поэтому ОС держит одну копию
+данных на все процессы, а чтение рецепта по названию - это поиск в
+хэш-таблице и разбор только нужных полей.
+
+Формат файла (все числа little-endian):
+  заголовок     HEADER: сигнатура, версия, число рецептов, число слотов
+                индекса, время сборки (unix time), смещение и длина списка
+                полей, смещение индекса;
+  список полей  JSON-массив имён полей;
+  индекс        slots записей SLOT (8 байт blake2b названия, смещение
+                рецепта), открытая адресация с линейным пробированием,
+                смещение 0 - пустой слот;
+  рецепты       число полей, таблица полей RECORD_FIELD (номер поля,
+                смещение значения от начала рецепта, длина), значения
+                полей в JSON.
+
+Usage:
+  snapshot.py <file> [--mongo=<uri>] [--db=<name>]
+  snapshot.py -h | --help
+
+Options:
+  -h --help      Показать эту справку.
+  --mongo=<uri>  Адрес MongoDB [default: mongodb://localhost:27017].
+  --db=<name>    База MongoDB [default: benedict].
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+from docopt import docopt
+
+from logger import get_logger
+from mongo import fetch_all, run_sync
+
+log = get_logger(app_name='snapshot')
+
+MAGIC = b'BNDCTSNP'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIQQQ')
+SLOT = struct.Struct('<QQ')
+RECORD_COUNT = struct.Struct('<H')
+RECORD_FIELD = struct.Struct('<HII')
+
+
+def title_hash(title):
+    return int.from_bytes(hashlib.blake2b(title.encode(), digest_size=8).digest(), 'little')
+
+
+def _encode_record(recipe, field_ids):
+    values = [(field_ids[field], json.dumps(value, ensure_ascii=False, default=str).encode())
+              for field, value in recipe.items() if field != '_id']
+    offset = RECORD_COUNT.size + RECORD_FIELD.size * len(values)
+    parts = [RECORD_COUNT.pack(len(values))]
+    for field_id, data in values:
+        parts.append(RECORD_FIELD.pack(field_id, offset, len(data)))
+        offset += len(data)
+    parts.extend(data for _, data in values)
+    return b''.join(parts)
+
+
+def write_snapshot(path, recipes, built_at=None):
+    """
+    Записывает рецепты в файл снимка. Файл сначала пишется рядом под
+    временным именем и затем атомарно подменяет старый: процессы, которые
+    уже отобразили старый снимок, дочитывают его без ошибок.
+    built_at - время, на которое рецепты прочитаны из базы.
+    Возвращает число записанных рецептов.
+    """
+    if built_at is None:
+        built_at = time.time()
+    recipes = [recipe for recipe in recipes if recipe.get('title')]
+    fields = sorted({field for recipe in recipes for field in recipe if field != '_id'})
+    field_ids = {field: i for i, field in enumerate(fields)}
+    names = json.dumps(fields, ensure_ascii=False).encode()
+
+    slots = 1
+    while slots < len(recipes) * 2:
+        slots *= 2
+    names_offset = HEADER.size
+    index_offset = names_offset + len(names)
+    offset = index_offset + SLOT.size * slots
+
+    index = [(0, 0)] * slots
+    records = []
+    for recipe in recipes:
+        h = title_hash(recipe['title'])
+        slot = h & (slots - 1)
+        while index[slot][1]:
+            slot = (slot + 1) & (slots - 1)
+        index[slot] = (h, offset)
+        record = _encode_record(recipe, field_ids)
+        records.append(record)
+        offset += len(record)
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(recipes), slots, int(built_at), names_offset, len(names),
+                            index_offset))
+        f.write(names)
+        f.write(b''.join(SLOT.pack(h, record_offset) for h, record_offset in index))
+        for record in records:
+            f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(recipes)
+
+
+class RecipeSnapshot:
+    """
+    Источник рецептов из снимка. Интерфейс тот же, что у
+    recipes.RecipeCache: get(collection, title, fields) и
+    get_stale(title, fields). Рецепты, которых нет в снимке
+    (добавленные после его сборки), читаются через fallback.
+    Рецепты, изменённые после сборки снимка (о них сообщает
+    recipes_watcher через refresh), тоже читаются через fallback, пока не
+    будет подхвачен снимок, собранный позже изменения.
+    Подменённый файл снимка переоткрывает reload(), его сервер вызывает
+    периодически.
+    """
+
+    def __init__(self, path, fallback=None):
+        self.path = path
+        self.fallback = fallback
+        self.hits = 0
+        self.misses = 0
+        self._file = None
+        self._mmap = None
+        self._stat = None
+        # Название -> когда стало известно об изменении рецепта, None -
+        # изменилось неизвестно что (тогда время в changed_all)
+        self.changed = dict()
+        self.changed_all = None
+        self.open()
+
+    def open(self):
+        stat = os.stat(self.path)
+        f = open(self.path, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, slots, built_at, names_offset, names_len, index_offset = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            data.close()
+            f.close()
+            raise ValueError('{} is not a recipe snapshot'.format(self.path))
+        self.close()
+        self._file, self._mmap, self._stat = f, data, (stat.st_ino, stat.st_mtime_ns)
+        self.count, self.slots, self.index_offset, self.built_at = count, slots, index_offset, built_at
+        # Изменения, сделанные до сборки снимка, в нём уже есть
+        self.changed = {title: t for title, t in self.changed.items() if t >= built_at}
+        if self.changed_all is not None and self.changed_all < built_at:
+            self.changed_all = None
+        self.fields = json.loads(data[names_offset:names_offset + names_len].decode())
+        self.field_ids = {field: i for i, field in enumerate(self.fields)}
+        log.info('Recipe snapshot {} opened: {} recipes, {} bytes'.format(self.path, count, len(data)))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def refresh(self, titles=None):
+        """
+        Запоминает рецепты, изменённые после сборки снимка. Вызывается
+        recipes_watcher'ом со списком изменённых названий, None - изменено
+        неизвестно что.
+        """
+        now = time.time()
+        if titles is None:
+            self.changed_all = now
+        else:
+            self.changed.update((title, now) for title in titles)
+
+    def reload(self):
+        """
+        Переоткрывает снимок, если файл был подменён.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) != self._stat:
+            self.open()
+
+    def _find(self, title):
+        h = title_hash(title)
+        mask = self.slots - 1
+        slot = h & mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self._mmap, self.index_offset + slot * SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h and self._read(offset, ('title',)).get('title') == title:
+                return offset
+            slot = (slot + 1) & mask
+
+    def _read(self, offset, fields=None):
+        data = self._mmap
+        wanted = None if fields is None else {self.field_ids[f] for f in fields if f in self.field_ids}
+        count, = RECORD_COUNT.unpack_from(data, offset)
+        doc = dict()
+        for i in range(count):
+            field_id, value_offset, length = RECORD_FIELD.unpack_from(
+                data, offset + RECORD_COUNT.size + i * RECORD_FIELD.size)
+            if wanted is None or field_id in wanted:
+                start = offset + value_offset
+                doc[self.fields[field_id]] = json.loads(data[start:start + length].decode())
+        return doc
+
+    def is_current(self, title):
+        return self.changed_all is None and title not in self.changed
+
+    def lookup(self, title, fields=None):
+        """
+        Рецепт из снимка (только поля fields и title) или None.
+        """
+        if not title:
+            return None
+        offset = self._find(title)
+        if offset is None:
+            return None
+        if fields is not None:
+            fields = set(fields) | {'title'}
+        return self._read(offset, fields)
+
+    async def get(self, collection, title, fields=None):
+        doc = self.lookup(title, fields) if self.is_current(title) else None
+        if doc is not None:
+            self.hits += 1
+            return doc
+        self.misses += 1
+        if self.fallback is None:
+            return None
+        return await self.fallback.get(collection, title, fields)
+
+    async def prefetch(self, collection, titles, fields):
+        # Рецепты из снимка и так читаются без базы
+        missing = [title for title in titles
+                   if title and (not self.is_current(title) or self._find(title) is None)]
+        if missing and self.fallback is not None:
+            await self.fallback.prefetch(collection, missing, fields)
+
+    def get_stale(self, title, fields=None):
+        doc = None
+        if self.fallback is not None and (not self.is_current(title) or self._find(title) is None):
+            doc = self.fallback.get_stale(title, fields)
+        # Устаревший рецепт из снимка лучше, чем никакого
+        return doc if doc is not None else self.lookup(title, fields)
+
+    def stats(self):
+        return {'recipes': self.count, 'bytes': len(self._mmap) if self._mmap is not None else 0,
+                'hits': self.hits, 'misses': self.misses, 'changed': len(self.changed),
+                'built_at': self.built_at}
+
+
+async def build(db, path):
+    """
+    Собирает снимок из коллекции рецептов. Серверы переоткрывают его при
+    следующей проверке файла, кэши рецептов и поиска не сбрасываются.
+    """
+    built_at = time.time()
+    return write_snapshot(path, await fetch_all(db.recipes.find({}), None), built_at)
+
+
+def main():
+    from pymongo import MongoClient
+
+    args = docopt(__doc__)
+    client = MongoClient(args['--mongo'])
+    try:
+        count = run_sync(build(client[args['--db']], args['<file>']))
+    finally:
+        client.close()
+    print('{} recipes written to {}'.format(count, args['<file>']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import random
+
+from dialog import DialogHandler
+from matcher import IntentMatcher
+
+TABLES = ['main_tokens', 'step_tokens', 'recipe_list_tokens', 'recipe_selected_tokens']
+
+
+def process_tokens(tokens, token_list):
+    """
+    Прежний линейный проход по таблице команд из DialogHandler.process_tokens.
+    """
+    for handler, target_tokens in token_list.items():
+        if len(target_tokens.get('necessary', [])):
+            for n_token in target_tokens['necessary']:
+                if n_token in tokens:
+                    break
+            else:
+                continue
+
+        if len(target_tokens.get('one_of', [])):
+            for o_token in target_tokens['one_of']:
+                if type(o_token) is list:
+                    for o_token_item in o_token:
+                        if o_token_item not in tokens:
+                            break
+                    else:
+                        break
+                if o_token in tokens:
+                    break
+            else:
+                continue
+        return handler
+    return None
+
+
+def test_matcher_equals_linear_scan():
+    rnd = random.Random(0)
+    for table in TABLES:
+        token_list = getattr(DialogHandler, table)
+        matcher = IntentMatcher(token_list)
+        vocabulary = sorted(matcher.vocabulary) + ['рецепт', 'борщ', 'пожалуйста']
+        for _ in range(20000):
+            tokens = rnd.sample(vocabulary, rnd.randint(0, min(6, len(vocabulary))))
+            assert matcher.match(tokens) == process_tokens(tokens, token_list), (table, tokens)
+
+
+def test_compiled_tables_match_source():
+    for table in TABLES:
+        matcher = getattr(DialogHandler, table.replace('_tokens', '_matcher'))
+        assert matcher.intents == list(getattr(DialogHandler, table))